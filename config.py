@@ -16,6 +16,17 @@ def get_list(key, default_value):
     val = os.getenv(key, default_value)
     return [item.strip() for item in val.split(',') if item.strip()]
 
+def get_optional_int(key, default_value):
+    val = os.getenv(key, default_value)
+    return int(val) if val not in (None, '') else None
+
+def get_mapping(key, default_value):
+    # 格式: "KEY1:value1,KEY2:value2"
+    return dict(
+        (k.strip(), v.strip())
+        for k, v in (item.split(':', 1) for item in get_list(key, default_value) if ':' in item)
+    )
+
 # =================================================================
 # ================== Gemini AI Assistant Config ===================
 # =================================================================
@@ -31,6 +42,30 @@ GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', 'YOUR_API_KEY')
 GEMINI_BASE_URL = os.getenv('GEMINI_BASE_URL')
 ENABLE_GOOGLE_SEARCH = get_bool('ENABLE_GOOGLE_SEARCH', True) # 新增：联网搜索功能开关
 
+# 模型档位: 档位名 -> (模型名称, 思考预算)。思考预算留空表示使用模型默认设置，0 表示禁用思考。
+MODEL_TIERS = {
+    'lite': (os.getenv('MODEL_LITE', 'gemini-2.5-flash-lite'), get_optional_int('THINKING_BUDGET_LITE', '0')),
+    'standard': (os.getenv('MODEL_STANDARD', 'gemini-2.5-flash'), get_optional_int('THINKING_BUDGET_STANDARD', '')),
+    'pro': (os.getenv('MODEL_PRO', 'gemini-2.5-pro'), get_optional_int('THINKING_BUDGET_PRO', '')),
+}
+ROUTER_MODEL_TIER = os.getenv('ROUTER_MODEL_TIER', 'lite') # 意图路由器使用的档位
+SEGMENTATION_MODEL_TIER = os.getenv('SEGMENTATION_MODEL_TIER', 'standard')
+MODEL_TIER_BY_INTENT = get_mapping(
+    'MODEL_TIER_BY_INTENT',
+    'FUNCTION_CALL_INTENT:standard,GROUNDING_INTENT:standard,HYBRID_INTENT:standard,GENERAL_CONVERSATION_INTENT:standard'
+)
+LITE_MESSAGE_MAX_CHARS = get_int('LITE_MESSAGE_MAX_CHARS', 12) # 不超过该长度的普通对话使用 lite 档位
+GROUP_GENERAL_MODEL_TIER = os.getenv('GROUP_GENERAL_MODEL_TIER', '') # 群聊普通对话使用的档位，留空则与私聊相同
+MODEL_STATS_LOG_EVERY = get_int('MODEL_STATS_LOG_EVERY', 50) # 每 N 次模型调用输出一次档位统计
+
+# 连接池与保活
+HTTP_MAX_CONNECTIONS = get_int('HTTP_MAX_CONNECTIONS', 20)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = get_int('HTTP_MAX_KEEPALIVE_CONNECTIONS', 10)
+HTTP_KEEPALIVE_EXPIRY = get_int('HTTP_KEEPALIVE_EXPIRY', 300) # 空闲连接保留时间（秒）
+HTTP_TIMEOUT = get_int('HTTP_TIMEOUT', 300) # 单次请求超时（秒），0 表示不限
+CONNECTION_WARMUP = get_bool('CONNECTION_WARMUP', True) # 启动时预先建立到 Gemini API 的连接
+KEEPALIVE_PING_INTERVAL = get_int('KEEPALIVE_PING_INTERVAL', 60) # 空闲超过该时间（秒）时发送保活请求，0 表示禁用
+
 # [重要] AI 初始化提示词 (系统指令)
 def _load_system_prompt(primary_path='prompt.txt', fallback_path='prompt.txt.template'):
     """
@@ -65,12 +100,21 @@ AUTO_ACCEPT_FRIENDS = get_bool('AUTO_ACCEPT_FRIENDS', True)
 FRIEND_REMARK_PREFIX = os.getenv('FRIEND_REMARK_PREFIX', 'AI添加_') 
 CLEAR_HISTORY_COMMAND = os.getenv('CLEAR_HISTORY_COMMAND', '清除历史记录')
 MAX_HISTORY_TURNS = get_int('MAX_HISTORY_TURNS', 10) # 不设置默认保留最近10轮对话作为上下文
+GROUP_BATCH_ENABLED = get_bool('GROUP_BATCH_ENABLED', False) # 是否合并回答群聊中短时间内的多个 @ 提问
+GROUP_BATCH_WINDOW_MS = get_int('GROUP_BATCH_WINDOW_MS', 3000) # 收到第一条提问后最多等待多久再合并处理（毫秒）
+GROUP_BATCH_MAX_SIZE = get_int('GROUP_BATCH_MAX_SIZE', 5) # 一次最多合并的提问数
+DEDUP_ENABLED = get_bool('DEDUP_ENABLED', True) # 是否忽略 wxauto 重复投递的消息
+DEDUP_WINDOW_SECONDS = get_int('DEDUP_WINDOW_SECONDS', 20) # 该时间窗口内相同的消息视为重复
+DEDUP_MAX_ENTRIES = get_int('DEDUP_MAX_ENTRIES', 5000) # 最多记录的消息指纹数量
+DEDUP_MESSAGE_TYPES = get_list('DEDUP_MESSAGE_TYPES', 'text') # 参与去重的消息类型（图片等消息内容不足以区分，默认不参与）
 
 
 # ---------------------- Image Processing Config ------------------
 IMAGE_DIR = os.getenv('IMAGE_DIR', 'images')
 IMAGE_CONTEXT_TTL = get_int('IMAGE_CONTEXT_TTL', 3000)
 IMAGE_RECEIVED_PROMPT = os.getenv('IMAGE_RECEIVED_PROMPT', "图片收到！请告诉我需要对它做什么。")
+SEGMENTATION_TOOL_TIMEOUT = get_int('SEGMENTATION_TOOL_TIMEOUT', 120) # 抠图工具单次执行的超时时间（秒），0 表示不限
+TOOL_STATS_LOG_EVERY = get_int('TOOL_STATS_LOG_EVERY', 20) # 每 N 次工具调用输出一次工具统计，0 表示不输出
 
 
 # ---------------------- System & Data Config ---------------------
@@ -78,4 +122,33 @@ HISTORY_DIR = os.getenv('HISTORY_DIR', 'history')
 LOG_DIR = os.getenv('LOG_DIR', 'logs')
 LOG_FILE_MAX_SIZE = get_int('LOG_FILE_MAX_SIZE', 10)
 LOG_FILE_BACKUP_COUNT = get_int('LOG_FILE_BACKUP_COUNT', 5)
-FRIEND_CHECK_INTERVAL = get_int('FRIEND_CHECK_INTERVAL', 300)
+FRIEND_CHECK_INTERVAL = get_int('FRIEND_CHECK_INTERVAL', 300) # 没有新申请时检查间隔逐步放宽到的最大值（秒）
+FRIEND_CHECK_MIN_INTERVAL = get_int('FRIEND_CHECK_MIN_INTERVAL', 30) # 发现新申请后的检查间隔（秒）
+FRIEND_ACCEPT_BATCH_SIZE = get_int('FRIEND_ACCEPT_BATCH_SIZE', 10) # 每轮最多接受的好友申请数
+FRIEND_ACCEPT_INTERVAL_MS = get_int('FRIEND_ACCEPT_INTERVAL_MS', 1000) # 两次接受好友申请之间的间隔（毫秒）
+
+
+# ---------------------- Deadline Config --------------------------
+# 每条消息从接收开始计时的处理预算（秒），0 表示不限时
+MESSAGE_DEADLINE_PRIVATE = get_int('MESSAGE_DEADLINE_PRIVATE', 120)
+MESSAGE_DEADLINE_GROUP = get_int('MESSAGE_DEADLINE_GROUP', 90)
+# 超过该存活时间（秒）的消息不再回复，0 表示从不丢弃
+STALE_MESSAGE_MAX_AGE_PRIVATE = get_int('STALE_MESSAGE_MAX_AGE_PRIVATE', 600)
+STALE_MESSAGE_MAX_AGE_GROUP = get_int('STALE_MESSAGE_MAX_AGE_GROUP', 180)
+# 排队时已耗尽处理预算但未超过最大存活时间的消息，开始处理时获得的短预算（秒），0 表示直接按超时处理
+LATE_MESSAGE_BUDGET = get_int('LATE_MESSAGE_BUDGET', 20)
+# 剩余预算低于该值（秒）时跳过意图路由，直接使用通用对话
+ROUTER_MIN_REMAINING = get_int('ROUTER_MIN_REMAINING', 30)
+# 剩余预算低于该值（秒）时不再联网搜索，降级为不带搜索的流程
+SEARCH_MIN_REMAINING = get_int('SEARCH_MIN_REMAINING', 45)
+
+
+# ---------------------- Performance Profiling Config -------------
+PROFILE_ENABLED = get_bool('PROFILE_ENABLED', False) # 是否开启消息处理剖析
+PROFILE_EVERY_N = get_int('PROFILE_EVERY_N', 1) # 每 N 条消息进行一次调用栈采样
+PROFILE_SAMPLE_INTERVAL_MS = get_int('PROFILE_SAMPLE_INTERVAL_MS', 10) # 调用栈采样间隔（毫秒）
+PROFILE_SLOW_THRESHOLD_MS = get_int('PROFILE_SLOW_THRESHOLD_MS', 15000) # 超过该耗时的消息会写出剖析数据
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_SWITCH_FILE = os.getenv('PROFILE_SWITCH_FILE', 'profile_switch.txt') # 运行时开关文件，无需重启即可生效
+LOOP_LAG_CHECK_INTERVAL_MS = get_int('LOOP_LAG_CHECK_INTERVAL_MS', 500)
+LOOP_LAG_WARN_MS = get_int('LOOP_LAG_WARN_MS', 200) # 事件循环延迟超过该值时记录警告
@@ -0,0 +1,94 @@
+import time
+from typing import Optional, Dict, Any
+import httpx
+from config import HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP_KEEPALIVE_EXPIRY, HTTP_TIMEOUT
+from logger import logger
+
+# =================================================================
+#  Gemini API 连接管理
+#
+#  为 genai.Client 提供一个显式配置连接池和 keep-alive 的 httpx.AsyncClient，
+#  并通过 httpcore 的 trace 扩展统计新建连接数、连接复用率以及
+#  TCP/TLS 建连耗时，便于评估预热和保活的效果。
+# =================================================================
+
+
+class ConnectionStats:
+    """连接建立与复用统计。"""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+        self.connect_ms_total = 0.0
+        self.tls_ms_total = 0.0
+        self.last_connect_ms: Optional[float] = None
+        self.last_request_at: Optional[float] = None
+
+    def reused_requests(self) -> int:
+        return max(self.requests - self.new_connections, 0)
+
+    def reuse_ratio(self) -> float:
+        return self.reused_requests() / self.requests if self.requests else 0.0
+
+    def summary(self) -> str:
+        avg_connect = self.connect_ms_total / self.new_connections if self.new_connections else 0
+        avg_tls = self.tls_ms_total / self.tls_handshakes if self.tls_handshakes else 0
+        return (
+            f"请求 {self.requests} 次，新建连接 {self.new_connections} 次，复用率 {self.reuse_ratio():.0%}，"
+            f"平均 TCP 建连 {avg_connect:.0f}ms，平均 TLS 握手 {avg_tls:.0f}ms"
+        )
+
+
+connection_stats = ConnectionStats()
+
+
+async def _attach_trace(request: httpx.Request):
+    """请求事件钩子：为每个请求挂载 httpcore trace 回调，记录建连阶段的耗时。"""
+    started: Dict[str, float] = {}
+    connection_stats.requests += 1
+    connection_stats.last_request_at = time.monotonic()
+
+    async def trace(event_name: str, info: Dict[str, Any]):
+        if event_name.endswith('.started'):
+            started[event_name[:-len('.started')]] = time.perf_counter()
+            return
+        if not event_name.endswith('.complete'):
+            return
+        phase = event_name[:-len('.complete')]
+        begin = started.pop(phase, None)
+        if begin is None:
+            return
+        elapsed_ms = (time.perf_counter() - begin) * 1000
+        if phase == 'connection.connect_tcp':
+            connection_stats.new_connections += 1
+            connection_stats.connect_ms_total += elapsed_ms
+            connection_stats.last_connect_ms = elapsed_ms
+            logger.debug(f"与 {request.url.host} 新建 TCP 连接，耗时 {elapsed_ms:.0f}ms")
+        elif phase == 'connection.start_tls':
+            connection_stats.tls_handshakes += 1
+            connection_stats.tls_ms_total += elapsed_ms
+            logger.debug(f"与 {request.url.host} 完成 TLS 握手，耗时 {elapsed_ms:.0f}ms")
+
+    request.extensions['trace'] = trace
+
+
+def build_async_http_client() -> httpx.AsyncClient:
+    """创建带连接池、keep-alive 配置和连接统计的 httpx.AsyncClient。"""
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(
+        limits=limits,
+        timeout=httpx.Timeout(HTTP_TIMEOUT or None),
+        event_hooks={'request': [_attach_trace]},
+    )
+
+
+def idle_seconds() -> Optional[float]:
+    """距离上一次请求的时间（秒）；尚未发出过请求时返回 None。"""
+    if connection_stats.last_request_at is None:
+        return None
+    return time.monotonic() - connection_stats.last_request_at
@@ -0,0 +1,76 @@
+import time
+from typing import Optional
+from config import (
+    MESSAGE_DEADLINE_PRIVATE, MESSAGE_DEADLINE_GROUP,
+    STALE_MESSAGE_MAX_AGE_PRIVATE, STALE_MESSAGE_MAX_AGE_GROUP, LATE_MESSAGE_BUDGET
+)
+from logger import logger
+
+# =================================================================
+#  端到端处理时限
+#
+#  每条消息从被接收时开始计时，携带一个处理预算 (budget)。
+#  各阶段（排队、意图路由、流程调用、发送）据此检查剩余时间，
+#  不足时跳过或降级；超过最大存活时间的消息则直接丢弃。
+#  排队期间就已耗尽预算、但尚未超过最大存活时间的消息，开始处理时
+#  改为从当前时刻起的一个较短预算，走降级流程而不是直接超时。
+# =================================================================
+
+
+class Deadline:
+    """
+    received_at: 消息被接收的时间戳 (time.time())。
+    budget: 端到端处理预算（秒），<= 0 表示不限时。
+    max_age: 超过该存活时间（秒）的消息不再回复，<= 0 表示不丢弃。
+    """
+
+    def __init__(self, received_at: float, budget: float, max_age: float):
+        self.received_at = received_at
+        self.budget = budget
+        self.max_age = max_age
+
+    def age(self) -> float:
+        return time.time() - self.received_at
+
+    def remaining(self) -> Optional[float]:
+        """剩余预算（秒）；不限时返回 None。"""
+        if self.budget <= 0:
+            return None
+        return self.budget - self.age()
+
+    def has_at_least(self, seconds: float) -> bool:
+        remaining = self.remaining()
+        return remaining is None or remaining >= seconds
+
+    def expired(self) -> bool:
+        return not self.has_at_least(0)
+
+    def is_stale(self) -> bool:
+        return self.max_age > 0 and self.age() > self.max_age
+
+    def ensure_minimum(self, seconds: float) -> bool:
+        """剩余预算不足 seconds 时延长到从现在起还有 seconds 秒；发生延长时返回 True。"""
+        if self.has_at_least(seconds):
+            return False
+        self.budget = self.age() + seconds
+        return True
+
+
+def create_deadline(received_at: float, is_group: bool) -> Deadline:
+    """按聊天类型（私聊/群聊）的策略为消息创建处理时限。"""
+    if is_group:
+        return Deadline(received_at, MESSAGE_DEADLINE_GROUP, STALE_MESSAGE_MAX_AGE_GROUP)
+    return Deadline(received_at, MESSAGE_DEADLINE_PRIVATE, STALE_MESSAGE_MAX_AGE_PRIVATE)
+
+
+def start_processing(deadline: Deadline, description: str) -> bool:
+    """
+    消息开始处理（出队）时调用：已超过最大存活时间的消息返回 False，应丢弃；
+    预算已在排队时耗尽的消息获得 LATE_MESSAGE_BUDGET 秒的短预算，以降级流程回复。
+    """
+    if deadline.is_stale():
+        logger.warning(f"{description} 已等待 {deadline.age():.0f} 秒，超过最大存活时间，已丢弃。")
+        return False
+    if deadline.expired() and LATE_MESSAGE_BUDGET > 0 and deadline.ensure_minimum(LATE_MESSAGE_BUDGET):
+        logger.warning(f"{description} 在排队中已等待 {deadline.age():.0f} 秒，超出处理预算，将在 {LATE_MESSAGE_BUDGET} 秒内以降级流程回复。")
+    return True
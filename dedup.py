@@ -0,0 +1,61 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# =================================================================
+#  重复消息抑制
+#
+#  wxauto 在重连或刷新窗口后可能重复投递同一条消息。这里以
+#  (聊天, 发送者, 内容哈希) 作为消息指纹，用一个按时间淘汰、容量有上限的
+#  LRU 记录指纹首次出现的时间，内存占用不随流量增长。
+# =================================================================
+
+
+class MessageDeduplicator:
+    """
+    线程安全的重复消息过滤器（在 wxauto 的回调线程中调用）。
+    window_seconds: 距首次出现不足该时间（秒）的相同消息视为重复；重复消息不会延长窗口。
+    max_entries: 最多保留的指纹数量，超出时淘汰最早的记录。
+    """
+
+    def __init__(self, window_seconds: int, max_entries: int):
+        self.window_seconds = max(window_seconds, 1)
+        self.max_entries = max(max_entries, 1)
+        self.suppressed_count = 0
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fingerprint(self, chat_name: str, sender: str, content: str) -> str:
+        content_hash = hashlib.blake2b(content.encode('utf-8'), digest_size=12).hexdigest()
+        return f"{chat_name}\x1f{sender}\x1f{content_hash}"
+
+    def _evict(self, now: float):
+        # 指纹按首次出现时间顺序排列，过期的都在队首
+        expire_before = now - self.window_seconds
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if seen_at > expire_before and len(self._seen) <= self.max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    def is_duplicate(self, chat_name: str, sender: str, content: str, now: Optional[float] = None) -> bool:
+        """检查消息是否重复；不重复时记录其指纹。"""
+        now = time.time() if now is None else now
+        key = self._fingerprint(chat_name, sender, content)
+        with self._lock:
+            self._evict(now)
+            first_seen = self._seen.get(key)
+            if first_seen is not None and now - first_seen < self.window_seconds:
+                self.suppressed_count += 1
+                return True
+            self._seen.pop(key, None)
+            self._seen[key] = now
+            if len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            return False
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
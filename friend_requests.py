@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+from logger import logger
+
+try:
+    import uiautomation
+except ImportError:  # wxauto 仅支持 Windows，其他环境（例如测试）中无需初始化 COM
+    uiautomation = None
+
+# =================================================================
+#  好友申请处理
+#
+#  wxauto 的 GetNewFriends / accept 都是阻塞的界面操作，这里放到一个
+#  单线程的后台执行器中运行，事件循环只负责调度：每轮最多接受一批申请，
+#  两次接受之间用 asyncio.sleep 限速。wxauto 基于 uiautomation (COM)，
+#  后台线程在整个生命周期内保持 COM 初始化，与 wxauto 自己的监听线程一致。
+#  成功接受或仍有积压时缩短检查间隔，成功接受或仍有积压时缩短检查间隔，
+#  空闲时逐步放宽到最大间隔。接受失败的申请按指数退避重试，
+#  不会一直占据批次的前列。
+# =================================================================
+
+# 失败申请的重试等待上限（秒）
+MAX_FAILED_RETRY_SECONDS = 6 * 3600
+
+_thread_state = threading.local()
+
+
+def _init_ui_automation_thread():
+    """执行器线程的 initializer：在线程内初始化 uiautomation，直到线程退出前调用 _release_ui_automation_thread。"""
+    if uiautomation is None:
+        return
+    initializer = uiautomation.UIAutomationInitializerInThread()
+    initializer.__enter__()
+    _thread_state.ui_automation = initializer
+
+
+def _release_ui_automation_thread():
+    initializer = getattr(_thread_state, 'ui_automation', None)
+    if initializer is not None:
+        _thread_state.ui_automation = None
+        initializer.__exit__(None, None, None)
+
+
+class AdaptivePollInterval:
+    """有活动时回到最小间隔，每次空闲检查后按倍数增长，直到最大间隔。"""
+
+    def __init__(self, min_seconds: float, max_seconds: float, growth: float = 2.0):
+        self.min_seconds = max(min_seconds, 1)
+        self.max_seconds = max(max_seconds, self.min_seconds)
+        self.growth = max(growth, 1.0)
+        self.current = self.min_seconds
+
+    def on_activity(self) -> float:
+        self.current = self.min_seconds
+        return self.current
+
+    def on_idle(self) -> float:
+        self.current = min(self.current * self.growth, self.max_seconds)
+        return self.current
+
+
+class FriendRequestWorker:
+    """
+    wx_instance: 支持 GetNewFriends 的 wxauto 实例（Plus 版）。
+    batch_size: 每轮最多接受的申请数，剩余的申请留到下一轮（按最小间隔很快再次检查）。
+    accept_interval: 两次接受之间的间隔（秒），不阻塞事件循环。
+    失败的申请在 max_interval * 2^(失败次数-1) 秒（最多 MAX_FAILED_RETRY_SECONDS）内不再重试。
+    未传入 executor 时创建一个已初始化 uiautomation 的单线程执行器，并在 close() 时关闭。
+    """
+
+    def __init__(self, wx_instance: Any, remark_prefix: str, batch_size: int, accept_interval: float,
+                 min_interval: float, max_interval: float, executor: Optional[ThreadPoolExecutor] = None):
+        self.wx = wx_instance
+        self.remark_prefix = remark_prefix
+        self.batch_size = max(batch_size, 1)
+        self.accept_interval = max(accept_interval, 0)
+        self.interval = AdaptivePollInterval(min_interval, max_interval)
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='friend-requests', initializer=_init_ui_automation_thread
+        )
+        self.accepted_total = 0
+        self.failed_total = 0
+        self.backlog = 0
+        self._failed: Dict[str, Tuple[int, float]] = {}  # 申请人 -> (失败次数, 下次可重试的时间)
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: func(*args, **kwargs))
+
+    def _record_failure(self, name: str, now: float):
+        failures = self._failed.get(name, (0, 0.0))[0] + 1
+        retry_after = min(self.interval.max_seconds * 2 ** min(failures - 1, 20), MAX_FAILED_RETRY_SECONDS)
+        self._failed[name] = (failures, now + retry_after)
+        logger.info(f"好友 '{name}' 的申请已失败 {failures} 次，将在 {retry_after:.0f} 秒后重试。")
+
+    async def poll_once(self) -> int:
+        """检查一次新的好友申请并接受其中一批，返回本轮成功接受的数量。"""
+        started = time.perf_counter()
+        logger.debug("正在检查新的好友申请...")
+        new_friends = await self._call(self.wx.GetNewFriends, acceptable=True) or []
+        # 已不在列表中的申请不再需要记录失败信息
+        pending_names = {friend_request.name for friend_request in new_friends}
+        self._failed = {name: info for name, info in self._failed.items() if name in pending_names}
+        now = time.monotonic()
+        eligible = [r for r in new_friends if self._failed.get(r.name, (0, 0.0))[1] <= now]
+        if not eligible:
+            self.backlog = 0
+            if new_friends:
+                logger.debug(f"{len(new_friends)} 条好友申请均在失败重试的等待期内。")
+            else:
+                logger.debug("没有发现新的好友申请。")
+            return 0
+
+        batch = eligible[:self.batch_size]
+        logger.info(f"发现 {len(new_friends)} 条新的好友申请，本轮处理 {len(batch)} 条...")
+        accepted = 0
+        for i, friend_request in enumerate(batch):
+            if i > 0 and self.accept_interval:
+                await asyncio.sleep(self.accept_interval)
+            remark = f"{self.remark_prefix}{friend_request.name}"
+            try:
+                await self._call(friend_request.accept, remark=remark)
+                accepted += 1
+                self._failed.pop(friend_request.name, None)
+                logger.info(f"已自动接受好友 '{friend_request.name}' 的申请，并设置备注为 '{remark}'。")
+            except Exception as e:
+                self.failed_total += 1
+                logger.error(f"处理好友 '{friend_request.name}' 的申请时失败: {e}")
+                self._record_failure(friend_request.name, time.monotonic())
+
+        self.accepted_total += accepted
+        self.backlog = len(eligible) - len(batch)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        logger.info(
+            f"[好友申请] 本轮接受 {accepted}/{len(batch)} 条，耗时 {elapsed_ms:.0f}ms，剩余积压 {self.backlog} 条"
+            f"（累计接受 {self.accepted_total}，失败 {self.failed_total}）。"
+        )
+        return accepted
+
+    async def close(self):
+        """释放执行器线程中的 uiautomation 并关闭自己创建的执行器。"""
+        if not self._owns_executor:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, _release_ui_automation_thread)
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def run(self):
+        """持续检查好友申请；检查间隔随活动情况自适应调整。退出时关闭执行器。"""
+        try:
+            while True:
+                accepted = 0
+                try:
+                    accepted = await self.poll_once()
+                except Exception as e:
+                    self.backlog = 0
+                    logger.error(f"检查好友申请时发生未知错误: {e}")
+                wait = self.interval.on_activity() if accepted or self.backlog else self.interval.on_idle()
+                logger.debug(f"下一次检查好友申请将在 {wait:.0f} 秒后。")
+                await asyncio.sleep(wait)
+        finally:
+            await self.close()
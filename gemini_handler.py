@@ -1,17 +1,26 @@
+import asyncio
 import json
 import os
+import sys
 import PIL.Image
 import io
 import base64
 import binascii
+import hashlib
+import unicodedata
 import numpy as np
-from typing import Optional, Any, List, Dict
+from typing import Optional, Any, List, Dict, Tuple
 from PIL import Image, ImageDraw
 import time
 from google import genai
 from google.genai import types
-from config import GEMINI_API_KEY, GEMINI_BASE_URL, SYSTEM_PROMPT, HISTORY_DIR, MAX_HISTORY_TURNS, IMAGE_CONTEXT_TTL, ENABLE_GOOGLE_SEARCH
+from config import GEMINI_API_KEY, GEMINI_BASE_URL, SYSTEM_PROMPT, HISTORY_DIR, MAX_HISTORY_TURNS, IMAGE_CONTEXT_TTL, ENABLE_GOOGLE_SEARCH, ROUTER_MIN_REMAINING, SEARCH_MIN_REMAINING, KEEPALIVE_PING_INTERVAL, SEGMENTATION_TOOL_TIMEOUT
 from logger import logger
+from profiler import message_scope, stage
+from model_policy import ModelChoice, choose_model, apply_thinking_budget, record_call
+from deadline import Deadline
+from connection import build_async_http_client, connection_stats, idle_seconds
+from tool_registry import register_tool, get_tools, execute_tool_calls
 
 # --- 全局设置 ---
 
@@ -19,22 +28,81 @@ from logger import logger
 if not os.path.exists(HISTORY_DIR):
     os.makedirs(HISTORY_DIR)
 
-# 配置 API 客户端
+# 配置 API 客户端（使用自定义的 httpx 客户端以控制连接池和 keep-alive）
+http_client = build_async_http_client()
 if GEMINI_BASE_URL:
     cleaned_url = GEMINI_BASE_URL.strip().rstrip('/')
     logger.debug(f"正在使用自定义端点: {cleaned_url}")
-    http_opts = types.HttpOptions(base_url = cleaned_url)
-    client = genai.Client(api_key=GEMINI_API_KEY, http_options=http_opts)
+    http_opts = types.HttpOptions(base_url = cleaned_url, httpx_async_client=http_client)
 else:
-    client = genai.Client(api_key=GEMINI_API_KEY)
+    http_opts = types.HttpOptions(httpx_async_client=http_client)
+client = genai.Client(api_key=GEMINI_API_KEY, http_options=http_opts)
+
+async def _generate_content_async(choice: ModelChoice, contents: Any, config: Optional[types.GenerateContentConfig] = None):
+    """按所选档位调用模型，并记录该档位的延迟和 token 消耗。"""
+    config = apply_thinking_budget(config, choice)
+    started = time.perf_counter()
+    try:
+        response = await client.aio.models.generate_content(model=choice.model, contents=contents, config=config)
+    except Exception:
+        record_call(choice, started, error=True)
+        raise
+    record_call(choice, started, response)
+    return response
+
+# --- 连接预热与保活 ---
+WARMUP_TIMEOUT = 15 # 预热请求的超时时间（秒），避免代理异常时阻塞启动
+
+async def _ping_api_async():
+    """发送一个轻量请求（查询模型信息），用于建立或保持到 API 的连接。"""
+    await client.aio.models.get(model=choose_model('router').model)
+
+async def warm_up_connection():
+    """启动时预先完成 TCP/TLS 建连，避免第一条消息承担建连开销。"""
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(_ping_api_async(), timeout=WARMUP_TIMEOUT)
+        logger.info(f"Gemini API 连接预热完成，耗时 {(time.perf_counter() - started) * 1000:.0f}ms。{connection_stats.summary()}")
+    except Exception as e:
+        logger.warning(f"Gemini API 连接预热失败: {e!r}")
+
+async def connection_keepalive_loop():
+    """
+    一个独立的异步任务，空闲超过 KEEPALIVE_PING_INTERVAL 秒时发送保活请求，
+    防止连接池中的连接因空闲被关闭。
+    """
+    if KEEPALIVE_PING_INTERVAL <= 0:
+        return
+    pings = 0
+    while True:
+        await asyncio.sleep(KEEPALIVE_PING_INTERVAL)
+        idle = idle_seconds()
+        if idle is not None and idle < KEEPALIVE_PING_INTERVAL:
+            continue
+        try:
+            await _ping_api_async()
+            pings += 1
+            logger.debug(f"已发送保活请求。{connection_stats.summary()}")
+            if pings % 10 == 0:
+                logger.info(f"[连接统计] {connection_stats.summary()}")
+        except Exception as e:
+            logger.warning(f"保活请求失败: {e}")
 
 # --- 图片上下文管理 ---
 last_image_context = {}
 
 def update_image_context(chat_name: str, path: str, timestamp: float):
     global last_image_context
-    last_image_context[chat_name] = {'path': path, 'timestamp': timestamp}
+    context = {'path': path, 'timestamp': timestamp}
+    last_image_context[chat_name] = context
     logger.info(f"已为 [{chat_name}] 更新图片上下文。")
+    # 先计算新图片的哈希，重复发送或转发的相同图片可以继续使用已有的分割缓存
+    try:
+        _get_image_hash(context)
+    except OSError as e:
+        logger.warning(f"无法读取 [{chat_name}] 的图片以计算哈希: {e}")
+    # 旧图片的分割缓存可能已不再被引用
+    _evict_segmentation_cache()
 
 def get_image_path_from_context(chat_name: str) -> Optional[str]:
     context = last_image_context.get(chat_name)
@@ -43,48 +111,133 @@ def get_image_path_from_context(chat_name: str) -> Optional[str]:
     elif context:
         del last_image_context[chat_name]
         logger.info(f"'{chat_name}' 的图片上下文已过期并被清除。")
+        _evict_segmentation_cache()
     return None
 
 # --- 对话历史记录 (JSON 实现) ---
 SESSIONS_FILE = os.path.join(HISTORY_DIR, 'sessions.json')
 
-def _content_to_dict(content: types.Content) -> Dict[str, Any]:
-    parts_list = []
-    if content.parts:
-        for part in content.parts:
-            if hasattr(part, 'text'):
-                parts_list.append({'text': part.text})
-    return {'role': content.role, 'parts': parts_list}
-
-def _dict_to_content(data: Dict[str, Any]) -> types.Content:
-    parts_list = []
-    for part_dict in data.get('parts', []):
-        if 'text' in part_dict:
-            parts_list.append(types.Part.from_text(text=part_dict['text']))
-    return types.Content(role=data.get('role'), parts=parts_list)
-
-def _load_sessions() -> Dict[str, Any]:
+def _estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按 1 个 token 计，其余字符按 4 个字符 1 个 token 计。"""
+    cjk_count = sum(1 for c in text if c >= '\u2e80')
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+class HistoryTurn:
+    """
+    一轮历史消息的紧凑表示。
+    持久化只保留角色和文本，因此内存中也只保存这些（角色字符串经过驻留），
+    另外缓存该轮的紧凑 JSON 和估算的 token 数。仅在构建请求时才转换为 types.Content。
+    """
+    __slots__ = ('role', 'texts', 'json', 'tokens')
+
+    def __init__(self, role: str, texts: Tuple[str, ...]):
+        self.role = sys.intern(role)
+        self.texts = texts
+        self.json = json.dumps(self.to_dict(), ensure_ascii=False, separators=(',', ':'))
+        self.tokens = sum(_estimate_tokens(text) for text in texts)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'role': self.role, 'parts': [{'text': text} for text in self.texts]}
+
+    def to_content(self) -> types.Content:
+        return types.Content(role=self.role, parts=[types.Part(text=text) for text in self.texts])
+
+def _content_to_turn(content: types.Content) -> HistoryTurn:
+    texts = tuple(part.text for part in content.parts or [] if part.text is not None)
+    return HistoryTurn(content.role or 'model', texts)
+
+def _dict_to_turn(data: Dict[str, Any]) -> HistoryTurn:
+    texts = tuple(part['text'] for part in data.get('parts', []) if part.get('text') is not None)
+    return HistoryTurn(data.get('role') or 'model', texts)
+
+def _load_sessions() -> Dict[str, List[HistoryTurn]]:
     if os.path.exists(SESSIONS_FILE):
         try:
             with open(SESSIONS_FILE, 'r', encoding='utf-8') as f:
                 logger.debug(f"从 '{SESSIONS_FILE}' 加载历史记录...")
                 sessions_dict = json.load(f)
                 return {
-                    chat_name: [_dict_to_content(msg) for msg in messages]
+                    chat_name: [_dict_to_turn(msg) for msg in messages]
                     for chat_name, messages in sessions_dict.items()
                 }
-        except (json.JSONDecodeError, FileNotFoundError, TypeError) as e:
+        except (json.JSONDecodeError, FileNotFoundError, TypeError, AttributeError) as e:
             logger.error(f"加载或解析历史记录文件失败: {e}。将创建新的历史记录文件。")
     return {}
 
-def _save_sessions(sessions: Dict[str, Any]):
+class _SerializedHistory:
+    """
+    单个聊天历史记录的序列化缓存。
+    每轮对话的紧凑 JSON 在 HistoryTurn 创建时生成一次，裁剪时从头部丢弃，
+    意图路由器的提示词和持久化都直接复用，同时维护一个估算的 token 总数。
+    """
+
+    def __init__(self):
+        self.json_parts: List[str] = []
+        self.token_counts: List[int] = []
+        self.token_total = 0
+        self._joined: Optional[str] = None
+
+    def append(self, turn: HistoryTurn):
+        self.json_parts.append(turn.json)
+        self.token_counts.append(turn.tokens)
+        self.token_total += turn.tokens
+        self._joined = None
+
+    def trim(self, keep_last: int):
+        drop = len(self.json_parts) - keep_last
+        if drop <= 0:
+            return
+        self.token_total -= sum(self.token_counts[:drop])
+        del self.json_parts[:drop]
+        del self.token_counts[:drop]
+        self._joined = None
+
+    def to_json(self) -> str:
+        if self._joined is None:
+            self._joined = '[' + ','.join(self.json_parts) + ']'
+        return self._joined
+
+    def __len__(self) -> int:
+        return len(self.json_parts)
+
+_serialized_histories: Dict[str, _SerializedHistory] = {}
+
+def _get_serialized_history(contact_name: str) -> _SerializedHistory:
+    """获取聊天的序列化缓存；缓存缺失或与历史记录长度不一致时重新构建。"""
+    history = conversation_sessions.get(contact_name, [])
+    serialized = _serialized_histories.get(contact_name)
+    if serialized is None or len(serialized) != len(history):
+        serialized = _SerializedHistory()
+        for turn in history:
+            serialized.append(turn)
+        _serialized_histories[contact_name] = serialized
+    return serialized
+
+def _append_history(contact_name: str, turns: List[HistoryTurn]):
+    serialized = _get_serialized_history(contact_name)
+    conversation_sessions.setdefault(contact_name, []).extend(turns)
+    for turn in turns:
+        serialized.append(turn)
+    logger.debug(f"'{contact_name}' 的历史记录约 {serialized.token_total} tokens。")
+
+def _trim_history(contact_name: str, keep_last: int) -> List[HistoryTurn]:
+    history = conversation_sessions.setdefault(contact_name, [])
+    if len(history) > keep_last:
+        _get_serialized_history(contact_name).trim(keep_last)
+        history = history[-keep_last:]
+        conversation_sessions[contact_name] = history
+    return history
+
+def _save_sessions():
+    """将全局的 conversation_sessions 写入文件。"""
     try:
+        # 直接拼接每个聊天已缓存的 JSON，避免每次保存都重新转换所有历史记录
+        chunks = [
+            f"{json.dumps(chat_name, ensure_ascii=False)}:{_get_serialized_history(chat_name).to_json()}"
+            for chat_name in conversation_sessions
+        ]
         with open(SESSIONS_FILE, 'w', encoding='utf-8') as f:
-            sessions_dict = {
-                chat_name: [_content_to_dict(msg) for msg in messages]
-                for chat_name, messages in sessions.items()
-            }
-            json.dump(sessions_dict, f, ensure_ascii=False, indent=4)
+            f.write('{' + ',\n'.join(chunks) + '}')
             logger.debug(f"历史记录已成功保存到 '{SESSIONS_FILE}'。")
     except Exception as e:
         logger.error(f"保存历史记录失败: {e}")
@@ -98,6 +251,77 @@ def _parse_json_from_gemini(json_output: str) -> str:
         json_output = json_output.split("```json")[1].split("```")[0]
     return json_output.strip()
 
+# --- 分割结果缓存 ---
+# 同一张图片（按内容哈希）+ 同一条归一化指令的分割结果会被缓存，
+# 包括模型返回的原始 JSON 和渲染好的抠图文件。缓存随图片上下文一起失效。
+_segmentation_cache: Dict[Tuple[str, str], Dict[str, Any]] = {}
+_PROMPT_FILLER_WORDS = ('请', '帮我', '帮忙', '麻烦', '一下')
+
+def _normalize_segmentation_prompt(user_prompt: str) -> str:
+    """忽略大小写、空白、标点和常见的客套词，使略有差异的重复指令命中同一缓存。"""
+    text = "".join(c for c in user_prompt.lower() if not c.isspace() and not unicodedata.category(c).startswith('P'))
+    for word in _PROMPT_FILLER_WORDS:
+        text = text.replace(word, '')
+    return text
+
+def _get_image_hash(context: Dict[str, Any]) -> str:
+    """计算并缓存图片上下文中图片文件的内容哈希。"""
+    if 'hash' not in context:
+        with open(context['path'], 'rb') as f:
+            context['hash'] = hashlib.sha256(f.read()).hexdigest()
+    return context['hash']
+
+def _evict_segmentation_cache():
+    """移除不再被任何有效图片上下文引用的分割缓存，并删除其输出文件。"""
+    now = time.time()
+    live_hashes = {
+        context['hash'] for context in last_image_context.values()
+        if 'hash' in context and now - context.get('timestamp', 0) < IMAGE_CONTEXT_TTL
+    }
+    for key in [key for key in _segmentation_cache if key[0] not in live_hashes]:
+        for file_path in _segmentation_cache.pop(key)['files']:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        logger.debug(f"已移除图片 {key[0][:12]} 的分割缓存。")
+
+def _render_segmentation_cutouts(img: PIL.Image.Image, items: List[Dict[str, Any]], output_dir: str, file_tag: str) -> List[str]:
+    """根据模型返回的分割结果，将每个对象抠出并保存为透明背景的 PNG 文件。"""
+    generated_files = []
+    base_img_rgba = img.convert('RGBA')
+    for i, item in enumerate(items):
+        box, png_b64, label = item.get("box_2d"), item.get("mask"), item.get("label", "unknown")
+        if not all([box, png_b64, label]): continue
+
+        # Bug-fix: 如果模型返回一个列表，安全地取出第一个元素
+        if isinstance(png_b64, list):
+            if not png_b64: continue # 如果列表为空则跳过
+            png_b64 = png_b64[0]
+
+        try:
+            logger.debug(f"Raw base64 content from model: {png_b64}")
+            mask_data = base64.b64decode(png_b64.removeprefix("data:image/png;base64,"))
+            mask_img = Image.open(io.BytesIO(mask_data))
+        except (binascii.Error, ValueError): continue
+        y0, x0, y1, x1 = [int(c / 1000 * s) for c, s in zip(box, [img.size[1], img.size[0], img.size[1], img.size[0]])]
+        if y0 >= y1 or x0 >= x1: continue
+        cutout_image = Image.new('RGBA', base_img_rgba.size, (0, 0, 0, 0))
+        mask_resized = mask_img.resize((x1 - x0, y1 - y0), PIL.Image.Resampling.BILINEAR)
+        full_mask = Image.new('L', base_img_rgba.size, 0)
+        full_mask.paste(mask_resized, (x0, y0))
+        cutout_image = Image.composite(base_img_rgba, cutout_image, full_mask)
+        safe_label = "".join(c for c in label if c.isalnum())
+        # 文件名带上缓存键的摘要，避免不同图片/指令的结果互相覆盖
+        output_filename = f"{safe_label}_{i}_{file_tag}.png"
+        output_path = os.path.abspath(os.path.join(output_dir, output_filename))
+        cutout_image.save(output_path)
+        generated_files.append(output_path)
+    return generated_files
+
+def _segmentation_success(generated_files: List[str]) -> dict:
+    return {'status': 'success', 'message': f"成功处理并生成了 {len(generated_files)} 张图片。", 'generated_files': generated_files}
+
 async def segment_image_async(chat_name: str, user_prompt: str) -> dict:
     output_dir = "segmentation_outputs"
     os.makedirs(output_dir, exist_ok=True)
@@ -106,52 +330,39 @@ async def segment_image_async(chat_name: str, user_prompt: str) -> dict:
         return {'status': 'failure', 'message': '我需要你先发一张图片，然后我才能处理。'}
     image_path = context['path']
     try:
+        _evict_segmentation_cache()
+        cache_key = (_get_image_hash(context), _normalize_segmentation_prompt(user_prompt))
+        cached = _segmentation_cache.get(cache_key)
+        if cached and all(os.path.exists(f) for f in cached['files']):
+            logger.info(f"分割缓存命中: [{chat_name}] '{user_prompt}'，直接返回 {len(cached['files'])} 张图片。")
+            return _segmentation_success(cached['files'])
+
         img = PIL.Image.open(image_path)
         img.thumbnail((1024, 1024), PIL.Image.Resampling.LANCZOS)
-        prompt = f'根据用户的指令 "{user_prompt}"，对图像中的对象进行分割。输出一个 JSON 列表，每个条目包含 "box_2d", "mask", 和 "label"。'
-        config = types.GenerateContentConfig(
-            response_mime_type="application/json",
-            thinking_config=types.ThinkingConfig(thinking_budget=0), # 为分割任务禁用思考，以提升效果
-            automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True)
-        )
-        response = await client.aio.models.generate_content(model='gemini-2.5-flash', contents=[prompt, img], config=config)
-        if not response.text:
-            return {'status': 'failure', 'message': '抱歉，模型没有返回有效的 JSON 数据。'}
-        logger.debug(f"Raw model response for JSON parsing: {response.text}")
-        items = json.loads(_parse_json_from_gemini(response.text))
+        if cached:
+            # 输出文件已被删除，但模型结果仍在缓存中，只需重新渲染
+            raw_json = cached['raw_json']
+        else:
+            prompt = f'根据用户的指令 "{user_prompt}"，对图像中的对象进行分割。输出一个 JSON 列表，每个条目包含 "box_2d", "mask", 和 "label"。'
+            config = types.GenerateContentConfig(
+                response_mime_type="application/json",
+                thinking_config=types.ThinkingConfig(thinking_budget=0), # 为分割任务禁用思考，以提升效果
+                automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True)
+            )
+            response = await _generate_content_async(choose_model('segmentation'), contents=[prompt, img], config=config)
+            if not response.text:
+                return {'status': 'failure', 'message': '抱歉，模型没有返回有效的 JSON 数据。'}
+            logger.debug(f"Raw model response for JSON parsing: {response.text}")
+            raw_json = _parse_json_from_gemini(response.text)
+        items = json.loads(raw_json)
         if not items:
             return {'status': 'failure', 'message': '抱歉，我没能在图片中识别出任何可分割的对象。'}
-        generated_files = []
-        base_img_rgba = img.convert('RGBA')
-        for i, item in enumerate(items):
-            box, png_b64, label = item.get("box_2d"), item.get("mask"), item.get("label", "unknown")
-            if not all([box, png_b64, label]): continue
-
-            # Bug-fix: 如果模型返回一个列表，安全地取出第一个元素
-            if isinstance(png_b64, list):
-                if not png_b64: continue # 如果列表为空则跳过
-                png_b64 = png_b64[0]
-
-            try:
-                logger.debug(f"Raw base64 content from model: {png_b64}")
-                mask_data = base64.b64decode(png_b64.removeprefix("data:image/png;base64,"))
-                mask_img = Image.open(io.BytesIO(mask_data))
-            except (binascii.Error, ValueError): continue
-            y0, x0, y1, x1 = [int(c / 1000 * s) for c, s in zip(box, [img.size[1], img.size[0], img.size[1], img.size[0]])]
-            if y0 >= y1 or x0 >= x1: continue
-            cutout_image = Image.new('RGBA', base_img_rgba.size, (0, 0, 0, 0))
-            mask_resized = mask_img.resize((x1 - x0, y1 - y0), PIL.Image.Resampling.BILINEAR)
-            full_mask = Image.new('L', base_img_rgba.size, 0)
-            full_mask.paste(mask_resized, (x0, y0))
-            cutout_image = Image.composite(base_img_rgba, cutout_image, full_mask)
-            safe_label = "".join(c for c in label if c.isalnum())
-            output_filename = f"{safe_label}_{i}.png"
-            output_path = os.path.abspath(os.path.join(output_dir, output_filename))
-            cutout_image.save(output_path)
-            generated_files.append(output_path)
+        file_tag = hashlib.sha1(f"{cache_key[0]}|{cache_key[1]}".encode('utf-8')).hexdigest()[:12]
+        generated_files = _render_segmentation_cutouts(img, items, output_dir, file_tag)
         if not generated_files:
             return {'status': 'failure', 'message': '我尝试处理了，但未能成功生成任何分割图片。'}
-        return {'status': 'success', 'message': f"成功处理并生成了 {len(generated_files)} 张图片。", 'generated_files': generated_files}
+        _segmentation_cache[cache_key] = {'raw_json': raw_json, 'files': generated_files}
+        return _segmentation_success(generated_files)
     except Exception as e:
         logger.error(f"工具 'segment_image' 执行失败: {e}", exc_info=True)
         return {'status': 'error', 'message': "抱歉，处理图片时遇到了一个内部错误，请稍后再试。"}
@@ -168,14 +379,21 @@ segment_image_declaration = types.FunctionDeclaration(
         required=['chat_name', 'user_prompt']
     )
 )
-segment_image_tool = types.Tool(function_declarations=[segment_image_declaration])
+
+async def _run_segment_image(contact_name: str, user_message: str, args: Dict[str, Any]) -> Dict[str, Any]:
+    # 在调用时查找 segment_image_async，分割实现可以被替换（例如测试中打补丁）
+    user_prompt = args.get('user_prompt') or user_message
+    return await segment_image_async(chat_name=contact_name, user_prompt=user_prompt)
+
+register_tool(segment_image_declaration, _run_segment_image, concurrent_safe=True, timeout=SEGMENTATION_TOOL_TIMEOUT)
 
 # --- v2.0 智能意图路由器 ---
 
-async def _intent_router_async(user_query: str, history: List[types.Content]) -> str:
-    """使用轻量级LLM对用户意图进行分类。"""
+async def _intent_router_async(user_query: str, history: List[HistoryTurn], history_str: Optional[str] = None) -> str:
+    """使用轻量级LLM对用户意图进行分类。history_str 为已缓存的历史记录 JSON，未提供时由各轮的 JSON 拼接。"""
     try:
-        history_str = json.dumps([_content_to_dict(msg) for msg in history], ensure_ascii=False, indent=2)
+        if history_str is None:
+            history_str = '[' + ','.join(turn.json for turn in history) + ']'
         router_prompt = f"""
 分析以下用户查询和对话历史，判断其主要意图。
 从以下四种意图中选择一个，并只返回意图的名称：
@@ -194,8 +412,8 @@ async def _intent_router_async(user_query: str, history: List[types.Content]) ->
 ```
 意图是:"""
         
-        response = await client.aio.models.generate_content(
-            model='gemini-2.5-flash',
+        response = await _generate_content_async(
+            choose_model('router'),
             contents=[router_prompt],
             config=types.GenerateContentConfig(temperature=0.0)
         )
@@ -228,9 +446,10 @@ def _format_citations_for_wechat(response) -> str:
         logger.error(f"格式化引用信息时出错: {e}")
     return final_text
 
-async def _execute_grounding_flow_async(full_contents: List[Any], system_prompt: str) -> tuple[str, Any]:
+async def _execute_grounding_flow_async(full_contents: List[Any], system_prompt: str, model_choice: Optional[ModelChoice] = None) -> tuple[str, Any]:
     """执行接地流程。"""
     logger.info("执行接地流程...")
+    model_choice = model_choice or choose_model('flow')
     config = types.GenerateContentConfig(
         system_instruction=system_prompt,
         tools=[types.Tool(google_search=types.GoogleSearch())],
@@ -240,8 +459,8 @@ async def _execute_grounding_flow_async(full_contents: List[Any], system_prompt:
             )
         )
     )
-    response = await client.aio.models.generate_content(
-        model='gemini-2.5-flash',
+    response = await _generate_content_async(
+        model_choice,
         contents=full_contents,
         config=config
     )
@@ -249,12 +468,13 @@ async def _execute_grounding_flow_async(full_contents: List[Any], system_prompt:
     model_response_content = response.candidates[0].content if response.candidates else None
     return final_text or "", model_response_content
 
-async def _execute_function_call_flow_async(full_contents: List[Any], system_prompt: str, contact_name: str, user_message: str) -> tuple[str, list, Optional[types.Content]]:
+async def _execute_function_call_flow_async(full_contents: List[Any], system_prompt: str, contact_name: str, user_message: str, model_choice: Optional[ModelChoice] = None) -> tuple[str, list, Optional[types.Content]]:
     """执行函数调用流程，并提供详细的日志记录。"""
     logger.info("--- 开始函数调用流程 ---")
+    model_choice = model_choice or choose_model('flow')
     logger.debug(f"输入参数: contact_name='{contact_name}', user_message='{user_message[:50]}...'")
     
-    available_tools = [segment_image_tool]
+    available_tools = get_tools()
     config = types.GenerateContentConfig(
         system_instruction=system_prompt,
         tools=available_tools,
@@ -264,8 +484,8 @@ async def _execute_function_call_flow_async(full_contents: List[Any], system_pro
     )
     
     logger.debug("步骤 1: 向模型发送初次请求，以确定是否需要调用工具。")
-    response = await client.aio.models.generate_content(
-        model='gemini-2.5-flash',
+    response = await _generate_content_async(
+        model_choice,
         contents=full_contents,
         config=config
     )
@@ -278,28 +498,20 @@ async def _execute_function_call_flow_async(full_contents: List[Any], system_pro
         logger.info("步骤 2: 模型请求调用工具。")
         logger.debug(f"请求调用的函数: {[fc.name for fc in response.function_calls]}")
         
+        tool_results = await execute_tool_calls(response.function_calls, contact_name, user_message)
         tool_response_parts = []
-        for func_call in response.function_calls:
-            if func_call.name == 'segment_image_async' and func_call.args:
-                user_prompt_from_model = func_call.args.get('user_prompt', user_message)
-                logger.debug(f"执行工具 'segment_image_async'，参数: chat_name='{contact_name}', user_prompt='{user_prompt_from_model}'")
-                tool_result = await segment_image_async(chat_name=contact_name, user_prompt=user_prompt_from_model)
-                logger.debug(f"工具 'segment_image_async' 返回结果: {tool_result}")
-                
-                if isinstance(tool_result, dict) and tool_result.get('status') == 'success':
-                    generated_files.extend(tool_result.get('generated_files', []))
-                    logger.info(f"工具执行成功，生成了 {len(tool_result.get('generated_files', []))} 个文件。")
-                else:
-                    logger.warning("工具执行失败或未生成文件。")
-                    
-                tool_response_parts.append(types.Part.from_function_response(name='segment_image_async', response=tool_result))
-        
+        for tool_name, tool_result in tool_results:
+            if isinstance(tool_result, dict) and tool_result.get('status') == 'success':
+                generated_files.extend(tool_result.get('generated_files', []))
+            tool_response_parts.append(types.Part.from_function_response(name=tool_name, response=tool_result))
+        logger.info(f"工具执行完成，共生成了 {len(generated_files)} 个文件。")
+
         if tool_response_parts:
             logger.info("步骤 3: 将工具执行结果返回给模型，以生成最终回复。")
             second_call_contents = full_contents + [model_response_content, types.Content(role='tool', parts=tool_response_parts)]
             
-            final_response = await client.aio.models.generate_content(
-                model='gemini-2.5-flash',
+            final_response = await _generate_content_async(
+                model_choice,
                 contents=second_call_contents,
                 config=types.GenerateContentConfig(system_instruction=system_prompt)
             )
@@ -319,9 +531,10 @@ async def _execute_function_call_flow_async(full_contents: List[Any], system_pro
     logger.info("--- 函数调用流程结束 (无实际调用) ---")
     return final_text or "", generated_files, model_response_content
 
-async def _execute_general_conversation_flow_async(full_contents: List[Any], system_prompt: str) -> tuple[str, Optional[types.Content]]:
+async def _execute_general_conversation_flow_async(full_contents: List[Any], system_prompt: str, model_choice: Optional[ModelChoice] = None) -> tuple[str, Optional[types.Content]]:
     """执行通用对话流程。"""
     logger.info("执行通用对话流程...")
+    model_choice = model_choice or choose_model('flow')
     config = types.GenerateContentConfig(
         system_instruction=system_prompt,
         tool_config=types.ToolConfig(
@@ -330,8 +543,8 @@ async def _execute_general_conversation_flow_async(full_contents: List[Any], sys
             )
         )
     )
-    response = await client.aio.models.generate_content(
-        model='gemini-2.5-flash',
+    response = await _generate_content_async(
+        model_choice,
         contents=full_contents,
         config=config
     )
@@ -339,15 +552,84 @@ async def _execute_general_conversation_flow_async(full_contents: List[Any], sys
     model_response_content = response.candidates[0].content if response.candidates else None
     return final_text or "", model_response_content
 
+async def _dispatch_intent_flow_async(intent: str, full_contents: List[Any], prompt_parts: List[Any], history_contents: List[types.Content], contact_name: str, user_message: str, is_group: bool = False, message_for_policy: Optional[str] = None) -> tuple[str, list, Optional[types.Content]]:
+    """根据意图选择执行路径。message_for_policy 为用于选择模型档位的原始提问（不含群聊发送者前缀），默认为 user_message。"""
+    has_image = any(not isinstance(part, str) for part in prompt_parts)
+    policy_message = user_message if message_for_policy is None else message_for_policy
+    model_choice = choose_model('flow', intent=intent, message=policy_message, is_group=is_group, has_image=has_image)
+    logger.info(f"意图 '{intent}' 使用模型档位 '{model_choice.tier}' ({model_choice.model})")
+    final_text = ""
+    generated_files = []
+    model_response_content = None
+    if intent == "FUNCTION_CALL_INTENT":
+        final_text, generated_files, model_response_content = await _execute_function_call_flow_async(full_contents, SYSTEM_PROMPT, contact_name, user_message, model_choice)
+    
+    elif intent == "GROUNDING_INTENT" and ENABLE_GOOGLE_SEARCH:
+        final_text, model_response_content = await _execute_grounding_flow_async(full_contents, SYSTEM_PROMPT, model_choice)
+
+    elif intent == "HYBRID_INTENT" and ENABLE_GOOGLE_SEARCH:
+        logger.info("执行混合流程...")
+        # 1. 接地获取上下文
+        grounding_text, _ = await _execute_grounding_flow_async(full_contents, SYSTEM_PROMPT, model_choice)
+        # 2. 增强查询并执行函数调用
+        enhanced_query = f"基于以下背景信息：\n{grounding_text}\n\n请处理我的请求：\n<user_query>{user_message}</user_query>"
+        enhanced_parts = [part for part in prompt_parts if not isinstance(part, str)] + [enhanced_query]
+        enhanced_full_contents = history_contents + enhanced_parts
+        final_text, generated_files, model_response_content = await _execute_function_call_flow_async(enhanced_full_contents, SYSTEM_PROMPT, contact_name, user_message, model_choice)
+
+    else: # GENERAL_CONVERSATION_INTENT 或回退情况
+        if intent != "GENERAL_CONVERSATION_INTENT":
+             logger.warning(f"意图 '{intent}' 的处理条件不满足（例如搜索被禁用），回退到通用对话。")
+        final_text, model_response_content = await _execute_general_conversation_flow_async(full_contents, SYSTEM_PROMPT, model_choice)
+    return final_text, generated_files, model_response_content
+
+# --- 处理时限 ---
+
+async def _await_within_deadline(coro, deadline: Optional[Deadline]):
+    """在消息剩余的处理预算内等待协程完成，超时则取消并抛出 asyncio.TimeoutError。"""
+    remaining = deadline.remaining() if deadline else None
+    if remaining is None:
+        return await coro
+    return await asyncio.wait_for(coro, timeout=max(remaining, 0))
+
+def _downgrade_intent_for_deadline(intent: str, deadline: Optional[Deadline]) -> str:
+    """剩余时间不足以完成联网搜索时，降级为不带搜索的流程。"""
+    if deadline is None or deadline.has_at_least(SEARCH_MIN_REMAINING):
+        return intent
+    downgraded = {"GROUNDING_INTENT": "GENERAL_CONVERSATION_INTENT", "HYBRID_INTENT": "FUNCTION_CALL_INTENT"}.get(intent, intent)
+    if downgraded != intent:
+        logger.warning(f"剩余处理时间不足 {SEARCH_MIN_REMAINING} 秒，意图 '{intent}' 降级为 '{downgraded}'。")
+    return downgraded
+
+def _resolve_intent(intent: str, deadline: Optional[Deadline]) -> str:
+    """得到实际会执行的意图：先按剩余时间降级，搜索被禁用时搜索类意图回退到通用对话（与 _dispatch_intent_flow_async 一致）。"""
+    intent = _downgrade_intent_for_deadline(intent, deadline)
+    if not ENABLE_GOOGLE_SEARCH and intent in ("GROUNDING_INTENT", "HYBRID_INTENT"):
+        return "GENERAL_CONVERSATION_INTENT"
+    return intent
+
 # --- 主逻辑 ---
 
-async def get_ai_response_async(contact_name: str, user_message: str, image_path: Optional[str] = None, is_group: bool = False, sender_name: Optional[str] = None) -> tuple[str, list]:
+# 同一聊天的请求串行执行，保证历史记录的一致性（群聊批量回复与普通回复可能并发）
+_chat_locks: Dict[str, asyncio.Lock] = {}
+
+def _get_chat_lock(contact_name: str) -> asyncio.Lock:
+    return _chat_locks.setdefault(contact_name, asyncio.Lock())
+
+async def get_ai_response_async(contact_name: str, user_message: str, image_path: Optional[str] = None, is_group: bool = False, sender_name: Optional[str] = None, deadline: Optional[Deadline] = None, intent: Optional[str] = None, message_for_policy: Optional[str] = None) -> tuple[str, list]:
+    """
+    intent: 已知的意图（例如群聊批量路由的结果），提供时跳过意图路由。
+    message_for_policy: 用于选择模型档位的原始提问；群聊中 user_message 带有发送者前缀时传入。
+    """
+    async with message_scope('get_ai_response_async'), _get_chat_lock(contact_name):
+        return await _get_ai_response_impl_async(contact_name, user_message, image_path, is_group, sender_name, deadline, intent, message_for_policy)
+
+async def _get_ai_response_impl_async(contact_name: str, user_message: str, image_path: Optional[str], is_group: bool, sender_name: Optional[str], deadline: Optional[Deadline], intent: Optional[str] = None, message_for_policy: Optional[str] = None) -> tuple[str, list]:
     try:
         # 步骤 1: 初始化和历史记录管理
         history = conversation_sessions.setdefault(contact_name, [])
-        if MAX_HISTORY_TURNS > 0 and len(history) > MAX_HISTORY_TURNS * 2:
-            history = history[-(MAX_HISTORY_TURNS * 2):]
-            conversation_sessions[contact_name] = history
+        if MAX_HISTORY_TURNS > 0:
+            history = _trim_history(contact_name, MAX_HISTORY_TURNS * 2)
         
         user_query_safe = f"<user_query>{user_message}</user_query>"
         final_user_message = f"请注意：你正在一个群聊中，当前向你提问的用户是“{sender_name}”。请结合上下文，并以对“{sender_name}”说话的口吻进行回复。\n\n用户的原始问题在下面的标签中：\n{user_query_safe}" if is_group and sender_name else user_query_safe
@@ -360,57 +642,163 @@ async def get_ai_response_async(contact_name: str, user_message: str, image_path
                 return "抱歉，我无法处理您发送的图片，它可能已损坏或格式不支持。", []
         prompt_parts.append(final_user_message if final_user_message else " ")
         
-        full_contents = history + prompt_parts
+        history_contents = [turn.to_content() for turn in history]
+        full_contents = history_contents + prompt_parts
         
-        # 步骤 2: 意图路由
-        intent = await _intent_router_async(user_message, history)
-        
-        final_text = ""
-        generated_files = []
-        model_response_content = None
+        # 步骤 2: 意图路由（剩余时间不足时跳过，直接使用通用对话）
+        with stage('intent_router'):
+            if intent is not None:
+                logger.info(f"使用已知意图 '{intent}'，跳过意图路由。")
+            elif deadline and not deadline.has_at_least(ROUTER_MIN_REMAINING):
+                logger.warning(f"剩余处理时间不足 {ROUTER_MIN_REMAINING} 秒，跳过意图路由。")
+                intent = "GENERAL_CONVERSATION_INTENT"
+            else:
+                try:
+                    intent = await _await_within_deadline(
+                        _intent_router_async(user_message, history, _get_serialized_history(contact_name).to_json()), deadline
+                    )
+                except asyncio.TimeoutError:
+                    logger.warning("意图路由超出处理时限，回退到通用对话。")
+                    intent = "GENERAL_CONVERSATION_INTENT"
+        intent = _downgrade_intent_for_deadline(intent, deadline)
 
         # 步骤 3: 根据意图选择执行路径
-        if intent == "FUNCTION_CALL_INTENT":
-            final_text, generated_files, model_response_content = await _execute_function_call_flow_async(full_contents, SYSTEM_PROMPT, contact_name, user_message)
-        
-        elif intent == "GROUNDING_INTENT" and ENABLE_GOOGLE_SEARCH:
-            final_text, model_response_content = await _execute_grounding_flow_async(full_contents, SYSTEM_PROMPT)
-
-        elif intent == "HYBRID_INTENT" and ENABLE_GOOGLE_SEARCH:
-            logger.info("执行混合流程...")
-            # 1. 接地获取上下文
-            grounding_text, _ = await _execute_grounding_flow_async(full_contents, SYSTEM_PROMPT)
-            # 2. 增强查询并执行函数调用
-            enhanced_query = f"基于以下背景信息：\n{grounding_text}\n\n请处理我的请求：\n<user_query>{user_message}</user_query>"
-            enhanced_parts = [part for part in prompt_parts if not isinstance(part, str)] + [enhanced_query]
-            enhanced_full_contents = history + enhanced_parts
-            final_text, generated_files, model_response_content = await _execute_function_call_flow_async(enhanced_full_contents, SYSTEM_PROMPT, contact_name, user_message)
-
-        else: # GENERAL_CONVERSATION_INTENT 或回退情况
-            if intent != "GENERAL_CONVERSATION_INTENT":
-                 logger.warning(f"意图 '{intent}' 的处理条件不满足（例如搜索被禁用），回退到通用对话。")
-            final_text, model_response_content = await _execute_general_conversation_flow_async(full_contents, SYSTEM_PROMPT)
+        with stage(f'flow:{intent}'):
+            final_text, generated_files, model_response_content = await _await_within_deadline(
+                _dispatch_intent_flow_async(intent, full_contents, prompt_parts, history_contents, contact_name, user_message, is_group, message_for_policy),
+                deadline
+            )
 
         # 步骤 4: 后处理和保存
         if not final_text:
              final_text = "我收到消息了，但好像没什么需要我做的。"
 
+        if deadline is not None and deadline.is_stale():
+            # 超过最大存活时间的回复不会被发送，也不写入历史，避免模型“记得”用户没收到的回答
+            logger.warning(f"[{contact_name}] 的回复生成完成时已超过最大存活时间，不写入历史记录。")
+            return final_text, generated_files
+
         if model_response_content:
-            # 创建一个仅包含文本的用户消息部分用于存储
-            user_part_for_history = types.Content(role='user', parts=[types.Part.from_text(text=user_message)])
-            conversation_sessions[contact_name].extend([user_part_for_history, model_response_content])
+            # 用户消息只保存文本部分
+            _append_history(contact_name, [HistoryTurn('user', (user_message,)), _content_to_turn(model_response_content)])
         
-        _save_sessions(conversation_sessions)
+        with stage('save_sessions'):
+            _save_sessions()
         return final_text, generated_files
 
+    except asyncio.TimeoutError as e:
+        if deadline is None or not deadline.expired():
+            logger.error(f"调用 Gemini API 或工具时超时: {e}", exc_info=True)
+            return "抱歉，我现在有点忙，请稍后再试吧。", []
+        logger.warning(f"[{contact_name}] 的消息超出处理时限 (已等待 {deadline.age():.1f} 秒)，已取消本次处理。")
+        return "抱歉，这个问题处理得太久了，请稍后再问我一次吧。", []
     except Exception as e:
         logger.error(f"调用 Gemini API 或工具时出错: {e}", exc_info=True)
         return "抱歉，我现在有点忙，请稍后再试吧。", []
 
+# --- 群聊批量回复 ---
+
+batch_answers_schema = types.Schema(
+    type=types.Type.ARRAY,
+    items=types.Schema(
+        type=types.Type.OBJECT,
+        properties={
+            'index': types.Schema(type=types.Type.INTEGER, description="问题的编号。"),
+            'answer': types.Schema(type=types.Type.STRING, description="对该问题的回复。"),
+        },
+        required=['index', 'answer']
+    )
+)
+
+def _parse_batch_answers(response_text: str, count: int) -> List[Optional[str]]:
+    """解析模型返回的批量回复，按问题编号（从 1 开始）对齐；缺失的回复为 None。"""
+    answers: List[Optional[str]] = [None] * count
+    try:
+        items = json.loads(_parse_json_from_gemini(response_text))
+    except (json.JSONDecodeError, TypeError) as e:
+        logger.error(f"解析批量回复失败: {e}")
+        return answers
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        index, answer = item.get('index'), item.get('answer')
+        if isinstance(index, int) and 1 <= index <= count and isinstance(answer, str) and answer.strip():
+            answers[index - 1] = answer.strip()
+    return answers
+
+async def get_batched_ai_response_async(contact_name: str, questions: List[tuple[str, str]], deadline: Optional[Deadline] = None) -> tuple[List[Optional[str]], Optional[str]]:
+    """
+    将同一群聊中短时间内的多个 @ 提问合并为一次请求，返回 (与 questions 一一对应的回复, 意图)。
+    questions: [(提问者, 问题), ...]。
+    只有普通对话会被合并回答：若意图路由认为需要工具或搜索，则回复全部为 None，
+    由调用方带着返回的意图逐条走普通流程（无需再次路由）；个别缺失的回复同样为 None。
+    未能确定意图时返回的意图为 None。
+    """
+    async with message_scope('get_batched_ai_response_async'), _get_chat_lock(contact_name):
+        try:
+            history = conversation_sessions.setdefault(contact_name, [])
+            if MAX_HISTORY_TURNS > 0:
+                history = _trim_history(contact_name, MAX_HISTORY_TURNS * 2)
+
+            combined_query = "\n".join(f"{sender}: {question}" for sender, question in questions)
+            with stage('intent_router'):
+                if deadline and not deadline.has_at_least(ROUTER_MIN_REMAINING):
+                    intent = "GENERAL_CONVERSATION_INTENT"
+                else:
+                    intent = await _await_within_deadline(
+                        _intent_router_async(combined_query, history, _get_serialized_history(contact_name).to_json()), deadline
+                    )
+            intent = _resolve_intent(intent, deadline)
+            if intent != "GENERAL_CONVERSATION_INTENT":
+                logger.info(f"批量提问的意图为 '{intent}'，改为逐条处理。")
+                return [None] * len(questions), intent
+
+            question_blocks = "\n".join(
+                f"<question index=\"{i}\" sender=\"{sender}\">\n<user_query>{question}</user_query>\n</question>"
+                for i, (sender, question) in enumerate(questions, start=1)
+            )
+            batch_prompt = (
+                f"请注意：你正在一个群聊中，有 {len(questions)} 位用户几乎同时向你提问。"
+                "请结合上下文分别回答每个问题，并以对相应提问者说话的口吻回复。"
+                "为每个问题返回一个包含 index（问题编号）和 answer（回复内容）的条目。\n\n"
+                f"{question_blocks}"
+            )
+            config = types.GenerateContentConfig(
+                system_instruction=SYSTEM_PROMPT,
+                response_mime_type="application/json",
+                response_schema=batch_answers_schema,
+            )
+            model_choice = choose_model('flow', intent=intent, message="\n".join(question for _, question in questions), is_group=True)
+            with stage('flow:batch'):
+                response = await _await_within_deadline(
+                    _generate_content_async(model_choice, contents=[turn.to_content() for turn in history] + [batch_prompt], config=config), deadline
+                )
+            answers = _parse_batch_answers(response.text or "", len(questions))
+
+            answered = [(sender, answer) for (sender, _), answer in zip(questions, answers) if answer]
+            if answered and deadline is not None and deadline.is_stale():
+                logger.warning(f"[{contact_name}] 的批量回复生成完成时已超过最大存活时间，不写入历史记录。")
+            elif answered:
+                answered_questions = "\n".join(f"{sender}: {question}" for (sender, question), answer in zip(questions, answers) if answer)
+                model_text = "\n".join(f"@{sender} {answer}" for sender, answer in answered)
+                _append_history(contact_name, [HistoryTurn('user', (answered_questions,)), HistoryTurn('model', (model_text,))])
+                with stage('save_sessions'):
+                    _save_sessions()
+            logger.info(f"[{contact_name}] 批量回复了 {len(answered)}/{len(questions)} 个问题。")
+            return answers, intent
+
+        except asyncio.TimeoutError:
+            logger.warning(f"[{contact_name}] 的批量提问超出处理时限，已取消本次处理。")
+            return ["抱歉，这个问题处理得太久了，请稍后再问我一次吧。"] * len(questions), None
+        except Exception as e:
+            logger.error(f"批量调用 Gemini API 时出错: {e}", exc_info=True)
+            return [None] * len(questions), None
+
 def clear_history(contact_name: str) -> bool:
     if contact_name in conversation_sessions:
         conversation_sessions[contact_name] = []
-        _save_sessions(conversation_sessions)
+        _serialized_histories.pop(contact_name, None)
+        _save_sessions()
         logger.info(f"'{contact_name}' 的历史记录已成功清除。")
         return True
     else:
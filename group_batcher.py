@@ -0,0 +1,68 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple
+from logger import logger
+
+# =================================================================
+#  群聊 @ 提问合并
+#
+#  同一群聊中短时间内的多个 @ 提问先暂存，窗口到期或达到数量上限时
+#  作为一批交给处理函数，从而只进行一次意图路由和一次模型调用。
+# =================================================================
+
+
+class PendingMention(NamedTuple):
+    msg: Any
+    chat: Any
+    sender: str
+    question: str
+    deadline: Any
+
+
+class GroupMentionBatcher:
+    """
+    window_seconds: 收到一批中的第一条提问后最多等待多久再处理（限制额外延迟）。
+    max_size: 一批最多包含的提问数，达到后立即处理。
+    handler: 处理一批提问的协程函数 handler(chat_name, mentions)，在独立任务中运行。
+    """
+
+    def __init__(self, window_seconds: float, max_size: int, handler: Callable[[str, List[PendingMention]], Awaitable[None]]):
+        self.window_seconds = window_seconds
+        self.max_size = max(max_size, 1)
+        self.handler = handler
+        self._pending: Dict[str, List[PendingMention]] = {}
+        self._timers: Dict[str, asyncio.Task] = {}
+        self._running: set = set()
+
+    def add(self, chat_name: str, mention: PendingMention):
+        batch = self._pending.setdefault(chat_name, [])
+        batch.append(mention)
+        if len(batch) >= self.max_size:
+            self._flush(chat_name)
+        elif len(batch) == 1:
+            self._timers[chat_name] = asyncio.create_task(self._flush_later(chat_name))
+
+    async def _flush_later(self, chat_name: str):
+        await asyncio.sleep(self.window_seconds)
+        self._timers.pop(chat_name, None)
+        self._flush(chat_name)
+
+    def _flush(self, chat_name: str):
+        timer = self._timers.pop(chat_name, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(chat_name, [])
+        if not batch:
+            return
+        logger.info(f"[{chat_name}] 合并处理 {len(batch)} 条 @ 提问。")
+        task = asyncio.create_task(self._run_handler(chat_name, batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run_handler(self, chat_name: str, batch: List[PendingMention]):
+        try:
+            await self.handler(chat_name, batch)
+        except Exception as e:
+            logger.error(f"处理 [{chat_name}] 的批量提问时发生错误: {e}", exc_info=True)
+
+    def pending_count(self, chat_name: str) -> int:
+        return len(self._pending.get(chat_name, []))
@@ -1,6 +1,7 @@
 import asyncio
 import os
 import time
+from typing import List, Optional
 from wxauto import WeChat
 import config
 from logger import logger
@@ -14,14 +15,45 @@ FRIEND_REMARK_PREFIX = getattr(config, 'FRIEND_REMARK_PREFIX', 'AI添加_')
 CLEAR_HISTORY_COMMAND = getattr(config, 'CLEAR_HISTORY_COMMAND', '清除历史记录')
 IMAGE_DIR = getattr(config, 'IMAGE_DIR', 'images')
 FRIEND_CHECK_INTERVAL = getattr(config, 'FRIEND_CHECK_INTERVAL', 300)
+FRIEND_CHECK_MIN_INTERVAL = getattr(config, 'FRIEND_CHECK_MIN_INTERVAL', 30)
+FRIEND_ACCEPT_BATCH_SIZE = getattr(config, 'FRIEND_ACCEPT_BATCH_SIZE', 10)
+FRIEND_ACCEPT_INTERVAL_MS = getattr(config, 'FRIEND_ACCEPT_INTERVAL_MS', 1000)
+CONNECTION_WARMUP = getattr(config, 'CONNECTION_WARMUP', True)
+GROUP_BATCH_ENABLED = getattr(config, 'GROUP_BATCH_ENABLED', False)
+GROUP_BATCH_WINDOW_MS = getattr(config, 'GROUP_BATCH_WINDOW_MS', 3000)
+GROUP_BATCH_MAX_SIZE = getattr(config, 'GROUP_BATCH_MAX_SIZE', 5)
 IMAGE_RECEIVED_PROMPT = getattr(config, 'IMAGE_RECEIVED_PROMPT', "图片收到！请告诉我需要对它做什么。")
+DEDUP_ENABLED = getattr(config, 'DEDUP_ENABLED', True)
+DEDUP_WINDOW_SECONDS = getattr(config, 'DEDUP_WINDOW_SECONDS', 20)
+DEDUP_MAX_ENTRIES = getattr(config, 'DEDUP_MAX_ENTRIES', 5000)
+DEDUP_MESSAGE_TYPES = getattr(config, 'DEDUP_MESSAGE_TYPES', ['text'])
 
 # --- 导入重构后的异步AI处理函数 ---
-from gemini_handler import get_ai_response_async, clear_history, update_image_context, get_image_path_from_context
+from gemini_handler import get_ai_response_async, get_batched_ai_response_async, clear_history, update_image_context, get_image_path_from_context, warm_up_connection, connection_keepalive_loop
+from profiler import message_scope, stage, annotate, monitor_event_loop_lag
+from dedup import MessageDeduplicator
+from deadline import create_deadline, start_processing
+from group_batcher import GroupMentionBatcher, PendingMention
+from friend_requests import FriendRequestWorker
 
 # 创建一个异步任务队列
 task_queue = asyncio.Queue()
 
+# 重复消息过滤器（wxauto 重连或刷新窗口后可能重复投递消息）
+message_deduplicator = MessageDeduplicator(DEDUP_WINDOW_SECONDS, DEDUP_MAX_ENTRIES)
+
+def is_duplicate_message(msg, chat) -> bool:
+    """
+    根据 (聊天, 发送者, 内容) 判断消息是否为重复投递：距该消息首次出现不足 DEDUP_WINDOW_SECONDS 秒即视为重复。
+    """
+    if not DEDUP_ENABLED or msg.type not in DEDUP_MESSAGE_TYPES:
+        return False
+    chat_name = getattr(chat, 'who', '')
+    if message_deduplicator.is_duplicate(chat_name, msg.sender, msg.content):
+        logger.info(f"已忽略来自 [{chat_name}] {msg.sender} 的重复消息 (累计已忽略 {message_deduplicator.suppressed_count} 条)。")
+        return True
+    return False
+
 def create_message_callback(loop: asyncio.AbstractEventLoop):
     """
     创建一个闭包，捕获事件循环，用于线程安全地将任务放入队列。
@@ -29,57 +61,194 @@ def create_message_callback(loop: asyncio.AbstractEventLoop):
     def message_callback(msg, chat):
         """
         这是在 wxauto 后台线程中运行的回调函数。
-        它的作用是把收到的消息和关联的聊天窗口对象一起放入异步队列。
+        它的作用是把收到的消息、关联的聊天窗口对象和接收时间一起放入异步队列。
         """
         try:
-            if msg.attr != 'self':
+            if msg.attr != 'self' and not is_duplicate_message(msg, chat):
                 # 使用 call_soon_threadsafe 从另一个线程安全地与 asyncio 事件循环交互
-                loop.call_soon_threadsafe(task_queue.put_nowait, (msg, chat))
+                loop.call_soon_threadsafe(task_queue.put_nowait, (msg, chat, time.time()))
         except Exception as e:
             logger.error(f"[回调错误] {e}")
     return message_callback
 
-def process_friend_requests(wx_instance):
+async def friend_request_processor(wx_instance):
     """
-    检查并自动接受新的好友请求（同步函数）。
+    一个独立的异步任务，在后台线程中检查并自动接受好友请求，不阻塞消息处理。
     """
     if not AUTO_ACCEPT_FRIENDS:
         return
-        
-    try:
-        if not hasattr(wx_instance, 'GetNewFriends'):
-            logger.warning("配置项 AUTO_ACCEPT_FRIENDS 已开启，但当前 wxauto 版本不支持 'GetNewFriends' 功能。请安装 Plus 版 (wxautox) 以使用此功能。")
+    if not hasattr(wx_instance, 'GetNewFriends'):
+        logger.warning("配置项 AUTO_ACCEPT_FRIENDS 已开启，但当前 wxauto 版本不支持 'GetNewFriends' 功能。请安装 Plus 版 (wxautox) 以使用此功能。")
+        return
+
+    worker = FriendRequestWorker(
+        wx_instance,
+        remark_prefix=FRIEND_REMARK_PREFIX,
+        batch_size=FRIEND_ACCEPT_BATCH_SIZE,
+        accept_interval=FRIEND_ACCEPT_INTERVAL_MS / 1000,
+        min_interval=FRIEND_CHECK_MIN_INTERVAL,
+        max_interval=FRIEND_CHECK_INTERVAL,
+    )
+    await worker.run()
+
+async def handle_message(msg, chat, received_at: float):
+    """
+    处理单条消息：解析内容、调用 AI 并发送回复。
+    received_at 为消息被接收的时间，用于计算处理时限。
+    """
+    with stage('chat_info'):
+        chat_info = chat.ChatInfo()
+    chat_name = chat_info.get('chat_name', msg.sender)
+    is_group = chat_info.get('chat_type') == 'group'
+    deadline = create_deadline(received_at, is_group)
+    annotate(chat_name=chat_name, sender=msg.sender, msg_type=msg.type, queue_wait_ms=round(deadline.age() * 1000, 2))
+
+    if not start_processing(deadline, f"来自 [{chat_name}] {msg.sender} 的消息"):
+        return
+
+    user_message = ""
+    image_path = None
+    text_response = None
+    files_to_send = []
+
+    if msg.attr == 'tickle':
+        bot_name_in_tickle = GROUP_BOT_NAME.lstrip('@')
+        if bot_name_in_tickle in msg.content:
+            user_message = f"[{msg.sender} 拍了拍我]"
+        else:
             return
+    elif msg.type == 'image':
+        try:
+            if not os.path.exists(IMAGE_DIR):
+                os.makedirs(IMAGE_DIR)
+            with stage('download_image'):
+                downloaded_path = msg.download(dir_path=IMAGE_DIR)
+            update_image_context(
+                chat_name=chat_name,
+                path=os.path.abspath(downloaded_path),
+                timestamp=time.time()
+            )
+            text_response = IMAGE_RECEIVED_PROMPT
+        except Exception as e:
+            logger.error(f"下载或处理图片上下文失败: {e}")
+            return
+    elif msg.type == 'voice':
+        try:
+            with stage('voice_to_text'):
+                user_message = msg.to_text()
+            if not user_message:
+                return
+        except Exception as e:
+            logger.error(f"语音转文字失败: {e}")
+            return
+    elif msg.type == 'text':
+        user_message = msg.content.strip()
+        image_path = get_image_path_from_context(chat_name)
+
+    final_user_message = user_message
+    message_for_policy = None
+    should_process = False
+    is_clear_command = (user_message == CLEAR_HISTORY_COMMAND)
 
-        logger.info("正在检查新的好友申请...")
-        new_friends = wx_instance.GetNewFriends(acceptable=True)
-        if not new_friends:
-            logger.info("没有发现新的好友申请。")
+    if is_group:
+        at_name_with_symbol = f"@{GROUP_BOT_NAME}" if not GROUP_BOT_NAME.startswith('@') else GROUP_BOT_NAME
+        if at_name_with_symbol in user_message:
+            stripped_message = user_message.replace(at_name_with_symbol, "").strip()
+            if stripped_message == CLEAR_HISTORY_COMMAND:
+                is_clear_command = True
+            elif GROUP_BATCH_ENABLED and msg.type == 'text' and stripped_message and not image_path:
+                # 纯文本的 @ 提问先暂存，与短时间内的其他提问合并回答
+                group_batcher.add(chat_name, PendingMention(msg, chat, msg.sender, stripped_message, deadline))
+                return
+            else:
+                final_user_message = f"{msg.sender}: {stripped_message}"
+                message_for_policy = stripped_message
+                should_process = True
+        elif not is_clear_command:
             return
+    else:
+        should_process = not is_clear_command
+
+    if is_clear_command:
+        if clear_history(chat_name):
+            text_response = "好的，我已经忘记我们之前聊过什么了。有什么新话题吗？"
+        else:
+            text_response = "嗯...我好像还不认识你，没有找到我们的聊天记录。"
+    
+    if should_process and (final_user_message or image_path):
+        logger.info(f"准备调用AI处理: '{final_user_message}' (图片: {'有' if image_path else '无'})")
+        # 调用异步AI处理函数
+        text_response, files_to_send = await get_ai_response_async(
+            contact_name=chat_name,
+            user_message=final_user_message,
+            image_path=image_path,
+            is_group=is_group,
+            sender_name=msg.sender,
+            deadline=deadline,
+            message_for_policy=message_for_policy
+        )
+    elif not text_response and not is_clear_command:
+        logger.info(f"收到来自 [{msg.sender}] 的空消息或不需处理的消息，已忽略。")
 
-        logger.info(f"发现 {len(new_friends)} 条新的好友申请，正在处理...")
-        for friend_request in new_friends:
+    await send_reply(msg, chat, chat_name, deadline, text_response, files_to_send)
+
+async def send_reply(msg, chat, chat_name: str, deadline, text_response: Optional[str], files_to_send: List[str]):
+    """
+    引用原消息发送文本回复，并依次发送生成的文件。已超过最大存活时间的回复不再发送。
+    """
+    if (text_response or files_to_send) and deadline.is_stale():
+        logger.warning(f"给 [{chat_name}] 的回复生成完成时已超过最大存活时间 ({deadline.age():.0f} 秒)，不再发送。")
+        return
+
+    if text_response:
+        try:
+            with stage('send_text'):
+                msg.quote(text_response)
+            logger.info(f"向 [{chat_name}] 发送文本回复成功。")
+        except Exception as send_e:
+            logger.error(f"发送文本回复失败: {send_e}")
+    
+    if files_to_send:
+        for file_path in files_to_send:
             try:
-                remark = f"{FRIEND_REMARK_PREFIX}{friend_request.name}"
-                friend_request.accept(remark=remark)
-                logger.info(f"已自动接受好友 '{friend_request.name}' 的申请，并设置备注为 '{remark}'。")
-                time.sleep(1)
+                with stage('send_file'):
+                    chat.SendFiles(file_path)
+                logger.info(f"向 [{chat_name}] 发送文件成功: {file_path}")
+                await asyncio.sleep(0.5)
             except Exception as e:
-                logger.error(f"处理好友 '{friend_request.name}' 的申请时失败: {e}")
-            
-    except Exception as e:
-        logger.error(f"检查好友申请时发生未知错误: {e}")
+                logger.error(f"发送文件 {file_path} 失败: {e}")
 
-async def friend_request_processor(wx_instance):
+async def answer_group_mentions(chat_name: str, mentions: List[PendingMention]):
     """
-    一个独立的异步任务，定期检查好友请求。
+    回复同一群聊中被合并的一批 @ 提问，每条回复引用对应的原消息。
+    只有一条提问或批量回复缺失时，按普通流程逐条处理（沿用批量路由得到的意图）。
     """
-    while True:
-        try:
-            process_friend_requests(wx_instance)
-        except Exception as e:
-            logger.error(f"好友请求处理器发生错误: {e}")
-        await asyncio.sleep(FRIEND_CHECK_INTERVAL)
+    async with message_scope('group_batch'):
+        annotate(chat_name=chat_name, batch_size=len(mentions))
+        mentions = [m for m in mentions if start_processing(m.deadline, f"来自 [{chat_name}] {m.sender} 的 @ 提问")]
+        answers, intent = [None] * len(mentions), None
+        if len(mentions) > 1:
+            batch_deadline = min((m.deadline for m in mentions), key=lambda d: d.remaining() or float('inf'))
+            answers, intent = await get_batched_ai_response_async(
+                contact_name=chat_name,
+                questions=[(m.sender, m.question) for m in mentions],
+                deadline=batch_deadline
+            )
+        for mention, answer in zip(mentions, answers):
+            files_to_send = []
+            if answer is None:
+                answer, files_to_send = await get_ai_response_async(
+                    contact_name=chat_name,
+                    user_message=f"{mention.sender}: {mention.question}",
+                    is_group=True,
+                    sender_name=mention.sender,
+                    deadline=mention.deadline,
+                    intent=intent,
+                    message_for_policy=mention.question
+                )
+            await send_reply(mention.msg, mention.chat, chat_name, mention.deadline, answer, files_to_send)
+
+group_batcher = GroupMentionBatcher(GROUP_BATCH_WINDOW_MS / 1000, GROUP_BATCH_MAX_SIZE, answer_group_mentions)
 
 async def message_consumer(wx_instance):
     """
@@ -87,103 +256,12 @@ async def message_consumer(wx_instance):
     """
     while True:
         try:
-            msg, chat = await task_queue.get()
-
-            chat_info = chat.ChatInfo()
-            chat_name = chat_info.get('chat_name', msg.sender)
-            is_group = chat_info.get('chat_type') == 'group'
-
-            user_message = ""
-            image_path = None
-            text_response = None
-            files_to_send = []
-
-            if msg.attr == 'tickle':
-                bot_name_in_tickle = GROUP_BOT_NAME.lstrip('@')
-                if bot_name_in_tickle in msg.content:
-                    user_message = f"[{msg.sender} 拍了拍我]"
-                else:
-                    continue
-            elif msg.type == 'image':
-                try:
-                    if not os.path.exists(IMAGE_DIR):
-                        os.makedirs(IMAGE_DIR)
-                    downloaded_path = msg.download(dir_path=IMAGE_DIR)
-                    update_image_context(
-                        chat_name=chat_name,
-                        path=os.path.abspath(downloaded_path),
-                        timestamp=time.time()
-                    )
-                    text_response = IMAGE_RECEIVED_PROMPT
-                except Exception as e:
-                    logger.error(f"下载或处理图片上下文失败: {e}")
-                    continue
-            elif msg.type == 'voice':
-                try:
-                    user_message = msg.to_text()
-                    if not user_message:
-                        continue
-                except Exception as e:
-                    logger.error(f"语音转文字失败: {e}")
-                    continue
-            elif msg.type == 'text':
-                user_message = msg.content.strip()
-                image_path = get_image_path_from_context(chat_name)
-
-            final_user_message = user_message
-            should_process = False
-            is_clear_command = (user_message == CLEAR_HISTORY_COMMAND)
-
-            if is_group:
-                at_name_with_symbol = f"@{GROUP_BOT_NAME}" if not GROUP_BOT_NAME.startswith('@') else GROUP_BOT_NAME
-                if at_name_with_symbol in user_message:
-                    stripped_message = user_message.replace(at_name_with_symbol, "").strip()
-                    if stripped_message == CLEAR_HISTORY_COMMAND:
-                        is_clear_command = True
-                    else:
-                        final_user_message = f"{msg.sender}: {stripped_message}"
-                        should_process = True
-                elif not is_clear_command:
-                    continue
-            else:
-                should_process = not is_clear_command
-
-            if is_clear_command:
-                if clear_history(chat_name):
-                    text_response = "好的，我已经忘记我们之前聊过什么了。有什么新话题吗？"
-                else:
-                    text_response = "嗯...我好像还不认识你，没有找到我们的聊天记录。"
-            
-            if should_process and (final_user_message or image_path):
-                logger.info(f"准备调用AI处理: '{final_user_message}' (图片: {'有' if image_path else '无'})")
-                # 调用异步AI处理函数
-                text_response, files_to_send = await get_ai_response_async(
-                    contact_name=chat_name,
-                    user_message=final_user_message,
-                    image_path=image_path,
-                    is_group=is_group,
-                    sender_name=msg.sender
-                )
-            elif not text_response and not is_clear_command:
-                logger.info(f"收到来自 [{msg.sender}] 的空消息或不需处理的消息，已忽略。")
-
-            if text_response:
-                try:
-                    msg.quote(text_response)
-                    logger.info(f"向 [{chat_name}] 发送文本回复成功。")
-                except Exception as send_e:
-                    logger.error(f"发送文本回复失败: {send_e}")
-            
-            if files_to_send:
-                for file_path in files_to_send:
-                    try:
-                        chat.SendFiles(file_path)
-                        logger.info(f"向 [{chat_name}] 发送文件成功: {file_path}")
-                        await asyncio.sleep(0.5)
-                    except Exception as e:
-                        logger.error(f"发送文件 {file_path} 失败: {e}")
-            
-            task_queue.task_done()
+            msg, chat, received_at = await task_queue.get()
+            try:
+                async with message_scope('message'):
+                    await handle_message(msg, chat, received_at)
+            finally:
+                task_queue.task_done()
 
         except Exception as e:
             logger.error(f"处理消息时发生未知错误: {e}", exc_info=True)
@@ -200,6 +278,10 @@ async def main():
         logger.error("错误: 请在 .env 文件或 config.py 中配置您的 GEMINI_API_KEY。")
         return
 
+    # 预先建立到 Gemini API 的连接，避免第一条消息承担建连开销
+    if CONNECTION_WARMUP:
+        await warm_up_connection()
+
     logger.info("正在初始化微信实例...")
     try:
         wx = WeChat()
@@ -230,9 +312,11 @@ async def main():
     # 创建并启动后台任务
     consumer_task = asyncio.create_task(message_consumer(wx))
     friend_checker_task = asyncio.create_task(friend_request_processor(wx))
+    loop_lag_task = asyncio.create_task(monitor_event_loop_lag())
+    keepalive_task = asyncio.create_task(connection_keepalive_loop())
 
     # 等待任务完成（实际上是永久运行）
-    await asyncio.gather(consumer_task, friend_checker_task)
+    await asyncio.gather(consumer_task, friend_checker_task, loop_lag_task, keepalive_task)
 
 if __name__ == "__main__":
     try:
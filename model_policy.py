@@ -0,0 +1,104 @@
+import time
+from typing import NamedTuple, Optional, Dict, Any
+from google.genai import types
+from config import (
+    MODEL_TIERS, ROUTER_MODEL_TIER, SEGMENTATION_MODEL_TIER, MODEL_TIER_BY_INTENT,
+    LITE_MESSAGE_MAX_CHARS, GROUP_GENERAL_MODEL_TIER, MODEL_STATS_LOG_EVERY
+)
+from logger import logger
+
+# =================================================================
+#  模型分级策略
+#
+#  根据调用用途（路由 / 对话流程 / 图片分割）、意图、消息长度和聊天类型，
+#  选择模型档位 (tier) 及对应的思考预算，并按档位统计延迟和 token 消耗。
+# =================================================================
+
+DEFAULT_TIER = 'standard'
+
+
+class ModelChoice(NamedTuple):
+    tier: str
+    model: str
+    thinking_budget: Optional[int]  # None 表示使用模型默认的思考设置
+
+
+def _resolve_tier(tier: str) -> ModelChoice:
+    if tier not in MODEL_TIERS:
+        logger.warning(f"未知的模型档位 '{tier}'，将回退到 '{DEFAULT_TIER}'。")
+        tier = DEFAULT_TIER
+    model, thinking_budget = MODEL_TIERS[tier]
+    return ModelChoice(tier, model, thinking_budget)
+
+
+def choose_model(purpose: str, intent: Optional[str] = None, message: str = "", is_group: bool = False, has_image: bool = False) -> ModelChoice:
+    """
+    为一次模型调用选择档位。
+    purpose: 'router'、'segmentation' 或 'flow'。
+    """
+    if purpose == 'router':
+        return _resolve_tier(ROUTER_MODEL_TIER)
+    if purpose == 'segmentation':
+        return _resolve_tier(SEGMENTATION_MODEL_TIER)
+
+    tier = MODEL_TIER_BY_INTENT.get(intent or '', DEFAULT_TIER)
+    if intent == 'GENERAL_CONVERSATION_INTENT' and not has_image:
+        # 简短的寒暄/问候无需思考，直接使用轻量档位
+        if len(message.strip()) <= LITE_MESSAGE_MAX_CHARS:
+            tier = 'lite'
+        elif is_group and GROUP_GENERAL_MODEL_TIER:
+            tier = GROUP_GENERAL_MODEL_TIER
+    return _resolve_tier(tier)
+
+
+def apply_thinking_budget(config: Optional[types.GenerateContentConfig], choice: ModelChoice) -> types.GenerateContentConfig:
+    """为请求配置加上档位对应的思考预算。调用方显式设置过 thinking_config 时保持不变。"""
+    if config is None:
+        config = types.GenerateContentConfig()
+    if choice.thinking_budget is not None and config.thinking_config is None:
+        config.thinking_config = types.ThinkingConfig(thinking_budget=choice.thinking_budget)
+    return config
+
+
+# --- 按档位统计 ---
+tier_stats: Dict[str, Dict[str, Any]] = {}
+_total_calls = 0
+
+
+def _token_count(usage, field: str) -> int:
+    value = getattr(usage, field, None) if usage is not None else None
+    return value if isinstance(value, int) else 0
+
+
+def record_call(choice: ModelChoice, started: float, response: Any = None, error: bool = False):
+    """记录一次模型调用的延迟和 token 消耗。started 为 time.perf_counter() 的返回值。"""
+    global _total_calls
+    latency_ms = (time.perf_counter() - started) * 1000
+    stats = tier_stats.setdefault(choice.tier, {
+        'calls': 0, 'errors': 0, 'total_latency_ms': 0.0, 'max_latency_ms': 0.0,
+        'prompt_tokens': 0, 'output_tokens': 0, 'thinking_tokens': 0,
+    })
+    stats['calls'] += 1
+    stats['total_latency_ms'] += latency_ms
+    stats['max_latency_ms'] = max(stats['max_latency_ms'], latency_ms)
+    if error:
+        stats['errors'] += 1
+    usage = getattr(response, 'usage_metadata', None)
+    stats['prompt_tokens'] += _token_count(usage, 'prompt_token_count')
+    stats['output_tokens'] += _token_count(usage, 'candidates_token_count')
+    stats['thinking_tokens'] += _token_count(usage, 'thoughts_token_count')
+    logger.debug(f"模型调用 [{choice.tier}/{choice.model}] 耗时 {latency_ms:.0f}ms")
+
+    _total_calls += 1
+    if MODEL_STATS_LOG_EVERY > 0 and _total_calls % MODEL_STATS_LOG_EVERY == 0:
+        log_tier_stats()
+
+
+def log_tier_stats():
+    for tier, stats in tier_stats.items():
+        avg_latency = stats['total_latency_ms'] / stats['calls'] if stats['calls'] else 0
+        logger.info(
+            f"[模型档位统计] {tier}: 调用 {stats['calls']} 次 (失败 {stats['errors']})，"
+            f"平均延迟 {avg_latency:.0f}ms，最大延迟 {stats['max_latency_ms']:.0f}ms，"
+            f"输入 {stats['prompt_tokens']} / 输出 {stats['output_tokens']} / 思考 {stats['thinking_tokens']} tokens"
+        )
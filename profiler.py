@@ -0,0 +1,261 @@
+import asyncio
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional, List, Dict, Any
+from config import (
+    PROFILE_ENABLED, PROFILE_EVERY_N, PROFILE_SAMPLE_INTERVAL_MS, PROFILE_SLOW_THRESHOLD_MS,
+    PROFILE_DIR, PROFILE_SWITCH_FILE, LOOP_LAG_CHECK_INTERVAL_MS, LOOP_LAG_WARN_MS
+)
+from logger import logger
+
+# =================================================================
+#  消息处理性能剖析
+#
+#  - 每条消息记录一份阶段时间线 (stage timeline)，开销仅为几次 perf_counter。
+#  - 每 N 条消息启用一次采样剖析：后台线程定期抓取事件循环线程的调用栈。
+#  - 处理耗时超过阈值时，将时间线 (.json) 和采样栈 (.folded，可直接用于火焰图) 写入磁盘。
+#  - 运行时可通过修改 PROFILE_SWITCH_FILE 开关或调整参数，无需重启。
+# =================================================================
+
+
+class _ProfilerSettings:
+    """当前生效的剖析参数，可被开关文件在运行时覆盖。"""
+
+    def __init__(self):
+        self.enabled = PROFILE_ENABLED
+        self.every_n = max(PROFILE_EVERY_N, 1)
+        self.sample_interval_ms = max(PROFILE_SAMPLE_INTERVAL_MS, 1)
+        self.slow_threshold_ms = PROFILE_SLOW_THRESHOLD_MS
+        self.loop_lag_warn_ms = LOOP_LAG_WARN_MS
+
+
+settings = _ProfilerSettings()
+_switch_file_mtime: Optional[float] = None
+_message_counter = 0
+
+
+def _apply_switch_line(key: str, value: str):
+    if key == 'enabled':
+        settings.enabled = value.lower() in ('true', '1', 't', 'on')
+    elif key == 'every_n':
+        settings.every_n = max(int(value), 1)
+    elif key == 'sample_interval_ms':
+        settings.sample_interval_ms = max(int(value), 1)
+    elif key == 'slow_threshold_ms':
+        settings.slow_threshold_ms = int(value)
+    elif key == 'loop_lag_warn_ms':
+        settings.loop_lag_warn_ms = int(value)
+    else:
+        logger.warning(f"剖析开关文件中存在未知配置项: '{key}'")
+
+
+def refresh_settings():
+    """
+    检查开关文件是否有变化，有变化则重新加载。
+    文件格式为每行一个 key=value，例如 "enabled=true"、"every_n=5"；
+    只写一个 "on"/"off" 也可以直接开关剖析。
+    """
+    global _switch_file_mtime
+    try:
+        mtime = os.stat(PROFILE_SWITCH_FILE).st_mtime
+    except OSError:
+        return
+    if mtime == _switch_file_mtime:
+        return
+    _switch_file_mtime = mtime
+    try:
+        with open(PROFILE_SWITCH_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if '=' in line:
+                    key, value = (item.strip() for item in line.split('=', 1))
+                    _apply_switch_line(key, value)
+                else:
+                    _apply_switch_line('enabled', line)
+        logger.info(f"已从 '{PROFILE_SWITCH_FILE}' 重新加载剖析配置: 启用={settings.enabled}, 每 {settings.every_n} 条采样一次, 慢消息阈值={settings.slow_threshold_ms}ms")
+    except (OSError, ValueError) as e:
+        logger.error(f"读取剖析开关文件失败: {e}")
+
+
+class MessageTrace:
+    """单条消息的处理轨迹：阶段时间线 + (可选的) 调用栈采样。"""
+
+    def __init__(self, label: str, sampled: bool):
+        self.label = label
+        self.sampled = sampled
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.thread_id = threading.get_ident()
+        self.stages: List[Dict[str, Any]] = []
+        self.meta: Dict[str, Any] = {}
+        self.samples: Counter = Counter()
+        self.finished = False
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'label': self.label,
+            'started_at': self.started_at,
+            'total_ms': round(self.elapsed_ms(), 2),
+            'sampled': self.sampled,
+            'sample_count': sum(self.samples.values()),
+            'meta': self.meta,
+            'stages': self.stages,
+        }
+
+
+_current_trace: contextvars.ContextVar[Optional[MessageTrace]] = contextvars.ContextVar('profiler_trace', default=None)
+_active_traces: List[MessageTrace] = []
+_sampler_thread: Optional[threading.Thread] = None
+_sampler_lock = threading.Lock()
+
+
+def _get_current_trace() -> Optional[MessageTrace]:
+    # 在消息处理中创建的后台任务会继承上下文，此时对应的轨迹可能已经结束
+    trace = _current_trace.get()
+    return trace if trace is not None and not trace.finished else None
+
+
+def _fold_stack(frame) -> str:
+    names = []
+    while frame is not None and len(names) < 64:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _sampler_loop():
+    global _sampler_thread
+    while True:
+        time.sleep(settings.sample_interval_ms / 1000)
+        with _sampler_lock:
+            traces = [trace for trace in _active_traces if trace.sampled]
+            if not traces:
+                # 没有需要采样的消息时线程退出，下一条被采样的消息会重新启动它
+                _sampler_thread = None
+                return
+        frames = sys._current_frames()
+        for trace in traces:
+            frame = frames.get(trace.thread_id)
+            if frame is not None:
+                trace.samples[_fold_stack(frame)] += 1
+
+
+def _register_trace(trace: MessageTrace):
+    global _sampler_thread
+    with _sampler_lock:
+        _active_traces.append(trace)
+        if trace.sampled and _sampler_thread is None:
+            _sampler_thread = threading.Thread(target=_sampler_loop, name='profiler-sampler', daemon=True)
+            _sampler_thread.start()
+
+
+def _unregister_trace(trace: MessageTrace):
+    with _sampler_lock:
+        _active_traces.remove(trace)
+
+
+def annotate(**kwargs):
+    """为当前消息轨迹附加元信息（如聊天名称、发送者）。"""
+    trace = _get_current_trace()
+    if trace is not None:
+        trace.meta.update(kwargs)
+
+
+@contextmanager
+def stage(name: str):
+    """记录一个处理阶段的开始时间和耗时。未处于剖析中时开销几乎为零。"""
+    trace = _get_current_trace()
+    if trace is None:
+        yield
+        return
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        trace.stages.append({
+            'stage': name,
+            'start_ms': round((begin - trace.start) * 1000, 2),
+            'duration_ms': round((end - begin) * 1000, 2),
+        })
+
+
+def _dump_trace(trace: MessageTrace) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    safe_label = "".join(c for c in trace.label if c.isalnum() or c in '_-')
+    base_name = time.strftime('%Y%m%d_%H%M%S', time.localtime(trace.started_at)) + f"_{int(trace.started_at * 1000) % 1000:03d}_{safe_label}"
+    base_path = os.path.join(PROFILE_DIR, base_name)
+    with open(base_path + '.json', 'w', encoding='utf-8') as f:
+        json.dump(trace.to_dict(), f, ensure_ascii=False, indent=4)
+    if trace.samples:
+        with open(base_path + '.folded', 'w', encoding='utf-8') as f:
+            for stack, count in trace.samples.most_common():
+                f.write(f"{stack} {count}\n")
+    return base_path
+
+
+@asynccontextmanager
+async def message_scope(label: str):
+    """
+    包裹一条消息的完整处理过程。
+    嵌套调用时（例如 message_consumer 内部调用 get_ai_response_async）只作为外层轨迹的一个阶段。
+    """
+    global _message_counter
+    parent = _get_current_trace()
+    if parent is not None:
+        with stage(label):
+            yield parent
+        return
+
+    refresh_settings()
+    if not settings.enabled:
+        yield None
+        return
+
+    _message_counter += 1
+    trace = MessageTrace(label, sampled=(_message_counter % settings.every_n == 0))
+    token = _current_trace.set(trace)
+    _register_trace(trace)
+    try:
+        yield trace
+    finally:
+        trace.finished = True
+        _unregister_trace(trace)
+        _current_trace.reset(token)
+        total_ms = trace.elapsed_ms()
+        logger.debug(f"[剖析] {trace.label} 耗时 {total_ms:.0f}ms, 阶段: {trace.stages}")
+        if total_ms >= settings.slow_threshold_ms:
+            try:
+                base_path = _dump_trace(trace)
+                logger.warning(f"[剖析] 慢消息: {trace.label} 耗时 {total_ms:.0f}ms (阈值 {settings.slow_threshold_ms}ms)，剖析数据已写入 '{base_path}.*'。")
+            except OSError as e:
+                logger.error(f"写入剖析数据失败: {e}")
+
+
+async def monitor_event_loop_lag():
+    """
+    一个独立的异步任务，定期测量事件循环延迟。
+    延迟 = 实际唤醒时间 - 预期唤醒时间，反映了是否有同步代码阻塞了事件循环。
+    """
+    interval = LOOP_LAG_CHECK_INTERVAL_MS / 1000
+    while True:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        lag_ms = (time.perf_counter() - expected) * 1000
+        refresh_settings()
+        if settings.enabled and lag_ms >= settings.loop_lag_warn_ms:
+            logger.warning(f"[剖析] 事件循环延迟 {lag_ms:.0f}ms，可能有同步操作阻塞了事件循环。")
+            for trace in _active_traces:
+                trace.meta.setdefault('loop_lag_ms', []).append(round(lag_ms, 2))
@@ -0,0 +1,67 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from google import genai
+from google.genai import types
+
+import connection
+
+
+class _StubGeminiHandler(BaseHTTPRequestHandler):
+    """模拟 Gemini API 的本地服务器，保持 HTTP/1.1 长连接。"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # 例如 /v1beta/models/gemini-2.5-flash-lite -> models/gemini-2.5-flash-lite
+        body = json.dumps({'name': self.path.split('/', 2)[-1]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubGeminiHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(connection, 'connection_stats', connection.ConnectionStats())
+
+@pytest.mark.asyncio
+async def test_requests_reuse_pooled_connection(stub_server):
+    http_client = connection.build_async_http_client()
+    client = genai.Client(api_key='test', http_options=types.HttpOptions(base_url=stub_server, httpx_async_client=http_client))
+
+    for _ in range(3):
+        model = await client.aio.models.get(model='gemini-2.5-flash-lite')
+        assert model.name == 'models/gemini-2.5-flash-lite'
+    await http_client.aclose()
+
+    stats = connection.connection_stats
+    assert stats.requests == 3
+    assert stats.new_connections == 1
+    assert stats.reused_requests() == 2
+    assert stats.last_connect_ms is not None
+    assert connection.idle_seconds() is not None
+
+@pytest.mark.asyncio
+async def test_closed_pool_opens_new_connection(stub_server):
+    for _ in range(2):
+        http_client = connection.build_async_http_client()
+        client = genai.Client(api_key='test', http_options=types.HttpOptions(base_url=stub_server, httpx_async_client=http_client))
+        await client.aio.models.get(model='gemini-2.5-flash-lite')
+        await http_client.aclose()
+
+    assert connection.connection_stats.new_connections == 2
+    assert connection.connection_stats.reuse_ratio() == 0
@@ -0,0 +1,46 @@
+import time
+
+from deadline import Deadline, create_deadline, start_processing
+from config import MESSAGE_DEADLINE_GROUP, STALE_MESSAGE_MAX_AGE_GROUP
+
+
+def test_remaining_budget_and_expiry():
+    deadline = Deadline(time.time() - 10, budget=30, max_age=0)
+    assert 19 < deadline.remaining() <= 20
+    assert deadline.has_at_least(15)
+    assert not deadline.has_at_least(25)
+    assert not deadline.expired()
+    assert Deadline(time.time() - 40, budget=30, max_age=0).expired()
+
+def test_unlimited_budget_never_expires():
+    deadline = Deadline(time.time() - 1000, budget=0, max_age=0)
+    assert deadline.remaining() is None
+    assert not deadline.expired()
+    assert not deadline.is_stale()
+
+def test_stale_message_detection():
+    assert Deadline(time.time() - 200, budget=0, max_age=180).is_stale()
+    assert not Deadline(time.time() - 100, budget=0, max_age=180).is_stale()
+
+def test_group_policy_is_applied():
+    deadline = create_deadline(time.time(), is_group=True)
+    assert deadline.budget == MESSAGE_DEADLINE_GROUP
+    assert deadline.max_age == STALE_MESSAGE_MAX_AGE_GROUP
+
+def test_late_but_not_stale_message_gets_short_budget(monkeypatch):
+    import deadline as deadline_module
+    monkeypatch.setattr(deadline_module, 'LATE_MESSAGE_BUDGET', 20)
+    deadline = Deadline(time.time() - 130, budget=120, max_age=600)
+    assert deadline.expired()
+
+    assert start_processing(deadline, "测试消息")
+    assert not deadline.expired()
+    assert 19 < deadline.remaining() <= 20
+
+def test_stale_message_is_dropped_at_start():
+    assert not start_processing(Deadline(time.time() - 700, budget=120, max_age=600), "测试消息")
+
+def test_ensure_minimum_keeps_sufficient_budget():
+    deadline = Deadline(time.time(), budget=120, max_age=0)
+    assert not deadline.ensure_minimum(20)
+    assert deadline.budget == 120
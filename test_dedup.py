@@ -0,0 +1,38 @@
+from dedup import MessageDeduplicator
+
+
+def test_duplicate_within_window_is_suppressed():
+    dedup = MessageDeduplicator(window_seconds=10, max_entries=100)
+    assert not dedup.is_duplicate('群聊', '小明', '你好', now=1000.0)
+    assert dedup.is_duplicate('群聊', '小明', '你好', now=1003.0)
+    assert dedup.suppressed_count == 1
+
+def test_window_is_measured_from_first_sighting():
+    dedup = MessageDeduplicator(window_seconds=10, max_entries=100)
+    assert not dedup.is_duplicate('群聊', '小明', '你好', now=1009.5)
+    assert dedup.is_duplicate('群聊', '小明', '你好', now=1019.0)
+    assert not dedup.is_duplicate('群聊', '小明', '你好', now=1019.5)
+
+def test_different_sender_chat_or_content_is_not_duplicate():
+    dedup = MessageDeduplicator(window_seconds=10, max_entries=100)
+    assert not dedup.is_duplicate('群聊', '小明', '你好', now=1000.0)
+    assert not dedup.is_duplicate('群聊', '小红', '你好', now=1000.0)
+    assert not dedup.is_duplicate('私聊', '小明', '你好', now=1000.0)
+    assert not dedup.is_duplicate('群聊', '小明', '你好呀', now=1000.0)
+    assert dedup.suppressed_count == 0
+
+def test_same_message_after_window_is_processed_again():
+    dedup = MessageDeduplicator(window_seconds=10, max_entries=100)
+    assert not dedup.is_duplicate('群聊', '小明', '你好', now=1000.0)
+    assert not dedup.is_duplicate('群聊', '小明', '你好', now=1025.0)
+
+def test_repeated_message_is_not_suppressed_forever():
+    dedup = MessageDeduplicator(window_seconds=20, max_entries=100)
+    results = [dedup.is_duplicate('私聊', '小明', '在吗', now=1000.0 + t) for t in range(0, 91, 15)]
+    assert results == [False, True, False, True, False, True, False]
+
+def test_memory_stays_bounded():
+    dedup = MessageDeduplicator(window_seconds=3600, max_entries=50)
+    for i in range(1000):
+        dedup.is_duplicate('群聊', '小明', f'消息{i}', now=1000.0 + i * 0.01)
+    assert len(dedup) <= 50
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import friend_requests
+from friend_requests import AdaptivePollInterval, FriendRequestWorker
+
+
+class FakeRequest:
+    def __init__(self, name, fail=False, delay=0.0):
+        self.name = name
+        self.fail = fail
+        self.delay = delay
+        self.remark = None
+
+    def accept(self, remark):
+        time.sleep(self.delay)  # 模拟阻塞的界面操作
+        if self.fail:
+            raise RuntimeError("accept failed")
+        self.remark = remark
+
+
+class FakeWeChat:
+    def __init__(self, requests):
+        self.requests = requests
+
+    def GetNewFriends(self, acceptable=True):
+        return [r for r in self.requests if r.remark is None]
+
+
+def _worker(wx, batch_size=10, accept_interval=0):
+    return FriendRequestWorker(wx, remark_prefix='AI添加_', batch_size=batch_size, accept_interval=accept_interval, min_interval=30, max_interval=300)
+
+def test_poll_interval_backs_off_when_idle_and_resets_on_activity():
+    interval = AdaptivePollInterval(min_seconds=30, max_seconds=100)
+    assert [interval.on_idle() for _ in range(3)] == [60, 100, 100]
+    assert interval.on_activity() == 30
+
+@pytest.mark.asyncio
+async def test_accepts_in_batches_and_reports_backlog():
+    requests = [FakeRequest(f'好友{i}') for i in range(5)]
+    worker = _worker(FakeWeChat(requests), batch_size=2)
+
+    assert await worker.poll_once() == 2
+    assert [r.remark for r in requests[:2]] == ['AI添加_好友0', 'AI添加_好友1']
+    assert requests[2].remark is None
+    assert worker.backlog == 3
+
+    await worker.poll_once()
+    await worker.poll_once()
+    assert worker.accepted_total == 5
+    assert await worker.poll_once() == 0
+    assert worker.backlog == 0
+
+@pytest.mark.asyncio
+async def test_failed_accept_is_counted_and_does_not_stop_the_batch():
+    requests = [FakeRequest('坏的', fail=True), FakeRequest('好的')]
+    worker = _worker(FakeWeChat(requests))
+
+    await worker.poll_once()
+
+    assert worker.failed_total == 1
+    assert worker.accepted_total == 1
+    assert requests[1].remark == 'AI添加_好的'
+
+@pytest.mark.asyncio
+async def test_failing_requests_do_not_starve_later_ones_or_keep_interval_short():
+    requests = [FakeRequest('坏的1', fail=True), FakeRequest('坏的2', fail=True), FakeRequest('好的')]
+    worker = _worker(FakeWeChat(requests), batch_size=2)
+
+    assert await worker.poll_once() == 0
+    assert worker.backlog == 1
+    assert await worker.poll_once() == 1
+    assert requests[2].remark == 'AI添加_好的'
+
+    assert await worker.poll_once() == 0
+    assert worker.backlog == 0
+    assert worker.failed_total == 2
+
+@pytest.mark.asyncio
+async def test_processing_does_not_block_the_event_loop():
+    requests = [FakeRequest(f'好友{i}', delay=0.05) for i in range(3)]
+    worker = _worker(FakeWeChat(requests), accept_interval=0.02)
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.005)
+            ticks += 1
+
+    ticker_task = asyncio.create_task(ticker())
+    await worker.poll_once()
+    ticker_task.cancel()
+
+    assert worker.accepted_total == 3
+    assert ticks >= 10
+
+def test_failed_retry_delay_is_capped():
+    worker = _worker(FakeWeChat([]))
+    for _ in range(30):
+        worker._record_failure('坏的', now=0.0)
+    assert worker._failed['坏的'] == (30, friend_requests.MAX_FAILED_RETRY_SECONDS)
+
+@pytest.mark.asyncio
+async def test_worker_thread_initializes_ui_automation_until_closed(monkeypatch):
+    events = []
+
+    class FakeInitializer:
+        def __enter__(self):
+            events.append(('enter', threading.current_thread().name))
+            return self
+
+        def __exit__(self, *exc_info):
+            events.append(('exit', threading.current_thread().name))
+
+    class FakeUIAutomation:
+        UIAutomationInitializerInThread = FakeInitializer
+
+    monkeypatch.setattr(friend_requests, 'uiautomation', FakeUIAutomation)
+    worker = _worker(FakeWeChat([FakeRequest('好友')]))
+
+    await worker.poll_once()
+    await worker.poll_once()
+    await worker.close()
+
+    assert [event for event, _ in events] == ['enter', 'exit']
+    assert all(name.startswith('friend-requests') for _, name in events)
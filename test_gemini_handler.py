@@ -1,5 +1,9 @@
 import pytest
 import asyncio
+import json
+import time
+import os
+import shutil
 from unittest.mock import patch, AsyncMock, MagicMock
 
 from google.genai import types
@@ -60,6 +64,14 @@ async def test_intent_router_fallback_on_unrecognized_intent():
     intent = await gemini_handler._intent_router_async("奇怪的请求", [])
     assert intent == "GENERAL_CONVERSATION_INTENT"
 
+@pytest.mark.asyncio
+async def test_intent_router_uses_router_model_tier():
+    mock_response = MagicMock()
+    mock_response.text = "GENERAL_CONVERSATION_INTENT"
+    mock_generate_content_func.return_value = mock_response
+    await gemini_handler._intent_router_async("你好", [])
+    assert mock_generate_content_func.call_args.kwargs['model'] == gemini_handler.choose_model('router').model
+
 @pytest.mark.asyncio
 async def test_intent_router_fallback_on_api_error():
     mock_generate_content_func.side_effect = Exception("API Error")
@@ -137,4 +149,282 @@ async def test_execute_general_conversation_flow_success():
 
     final_text, _ = await gemini_handler._execute_general_conversation_flow_async([types.Content(parts=[types.Part(text="你好")])], "系统提示")
 
-    assert final_text == "好的，没问题。"
\ No newline at end of file
+    assert final_text == "好的，没问题。"
+
+# --- 测试历史记录 ---
+def test_history_turn_round_trips_content():
+    content = types.Content(role='model', parts=[types.Part(text="第一段"), types.Part(function_call=types.FunctionCall(name='f', args={})), types.Part(text="第二段")])
+    turn = gemini_handler._content_to_turn(content)
+    assert turn.role == 'model'
+    assert turn.texts == ("第一段", "第二段")
+    assert json.loads(turn.json) == turn.to_dict() == {'role': 'model', 'parts': [{'text': '第一段'}, {'text': '第二段'}]}
+    rebuilt = turn.to_content()
+    assert isinstance(rebuilt, types.Content)
+    assert rebuilt.model_dump(exclude_none=True) == {'role': 'model', 'parts': [{'text': '第一段'}, {'text': '第二段'}]}
+
+
+def _text_turn(role, text):
+    return gemini_handler.HistoryTurn(role, (text,))
+
+def test_serialized_history_tracks_append_and_trim(monkeypatch):
+    monkeypatch.setattr(gemini_handler, 'conversation_sessions', {})
+    monkeypatch.setattr(gemini_handler, '_serialized_histories', {})
+
+    gemini_handler._append_history('chat', [_text_turn('user', '你好'), _text_turn('model', 'hello there')])
+    gemini_handler._append_history('chat', [_text_turn('user', '再见'), _text_turn('model', 'bye')])
+    serialized = gemini_handler._get_serialized_history('chat')
+    assert json.loads(serialized.to_json()) == [c.to_dict() for c in gemini_handler.conversation_sessions['chat']]
+
+    tokens_before = serialized.token_total
+    history = gemini_handler._trim_history('chat', 2)
+    assert len(history) == 2
+    assert json.loads(serialized.to_json()) == [{'role': 'user', 'parts': [{'text': '再见'}]}, {'role': 'model', 'parts': [{'text': 'bye'}]}]
+    assert 0 < serialized.token_total < tokens_before
+
+def test_save_sessions_round_trip(monkeypatch, tmp_path):
+    sessions_file = str(tmp_path / 'sessions.json')
+    monkeypatch.setattr(gemini_handler, 'SESSIONS_FILE', sessions_file)
+    monkeypatch.setattr(gemini_handler, 'conversation_sessions', {})
+    monkeypatch.setattr(gemini_handler, '_serialized_histories', {})
+
+    gemini_handler._append_history('群聊"A"', [_text_turn('user', '你好'), _text_turn('model', '你好呀')])
+    gemini_handler._append_history('chat_b', [_text_turn('user', 'hi')])
+    gemini_handler._save_sessions()
+
+    loaded = gemini_handler._load_sessions()
+    assert list(loaded) == ['群聊"A"', 'chat_b']
+    assert [c.to_dict() for c in loaded['群聊"A"']] == [
+        {'role': 'user', 'parts': [{'text': '你好'}]},
+        {'role': 'model', 'parts': [{'text': '你好呀'}]},
+    ]
+
+@pytest.mark.asyncio
+async def test_intent_router_uses_cached_history_json():
+    mock_response = MagicMock()
+    mock_response.text = "GENERAL_CONVERSATION_INTENT"
+    mock_generate_content_func.return_value = mock_response
+    await gemini_handler._intent_router_async("你好", [], '[{"role":"user","parts":[{"text":"缓存的历史"}]}]')
+    router_prompt = mock_generate_content_func.call_args.kwargs['contents'][0]
+    assert '缓存的历史' in router_prompt
+
+# --- 测试处理时限 ---
+@pytest.fixture
+def isolated_sessions(monkeypatch, tmp_path):
+    monkeypatch.setattr(gemini_handler, 'SESSIONS_FILE', str(tmp_path / 'sessions.json'))
+    monkeypatch.setattr(gemini_handler, 'conversation_sessions', {})
+    monkeypatch.setattr(gemini_handler, '_serialized_histories', {})
+
+@pytest.mark.asyncio
+async def test_short_deadline_skips_router(isolated_sessions):
+    mock_response = MagicMock()
+    mock_response.text = "你好！"
+    mock_response.candidates = [types.Candidate(content=types.Content(role='model', parts=[types.Part(text="你好！")]))]
+    mock_generate_content_func.return_value = mock_response
+
+    deadline = gemini_handler.Deadline(time.time(), budget=gemini_handler.ROUTER_MIN_REMAINING - 1, max_age=0)
+    final_text, _ = await gemini_handler.get_ai_response_async("test_chat", "你好", deadline=deadline)
+
+    assert final_text == "你好！"
+    assert mock_generate_content_func.call_count == 1
+
+def test_short_deadline_downgrades_search_intents():
+    deadline = gemini_handler.Deadline(time.time(), budget=gemini_handler.SEARCH_MIN_REMAINING - 1, max_age=0)
+    assert gemini_handler._downgrade_intent_for_deadline("GROUNDING_INTENT", deadline) == "GENERAL_CONVERSATION_INTENT"
+    assert gemini_handler._downgrade_intent_for_deadline("HYBRID_INTENT", deadline) == "FUNCTION_CALL_INTENT"
+    assert gemini_handler._downgrade_intent_for_deadline("GROUNDING_INTENT", None) == "GROUNDING_INTENT"
+
+@pytest.mark.asyncio
+async def test_flow_past_deadline_is_cancelled(isolated_sessions, monkeypatch):
+    monkeypatch.setattr(gemini_handler, 'ROUTER_MIN_REMAINING', 0)
+
+    async def slow_generate(**kwargs):
+        await asyncio.sleep(5)
+    mock_generate_content_func.side_effect = slow_generate
+
+    deadline = gemini_handler.Deadline(time.time(), budget=0.05, max_age=0)
+    final_text, generated_files = await gemini_handler.get_ai_response_async("test_chat", "你好", deadline=deadline)
+
+    assert "太久" in final_text
+    assert generated_files == []
+    assert gemini_handler.conversation_sessions["test_chat"] == []
+
+@pytest.mark.asyncio
+async def test_message_past_budget_but_not_stale_still_calls_model(isolated_sessions):
+    from deadline import start_processing
+    mock_response = MagicMock()
+    mock_response.text = "你好！"
+    mock_response.candidates = [types.Candidate(content=types.Content(role='model', parts=[types.Part(text="你好！")]))]
+    mock_generate_content_func.return_value = mock_response
+
+    deadline = gemini_handler.Deadline(time.time() - 130, budget=120, max_age=600)
+    assert start_processing(deadline, "测试消息")
+    final_text, _ = await gemini_handler.get_ai_response_async("test_chat", "你好", deadline=deadline)
+
+    assert final_text == "你好！"
+    assert mock_generate_content_func.call_count == 1
+
+@pytest.mark.asyncio
+async def test_stale_reply_is_not_written_to_history(isolated_sessions):
+    mock_response = MagicMock()
+    mock_response.text = "迟到的回答"
+    mock_response.candidates = [types.Candidate(content=types.Content(role='model', parts=[types.Part(text="迟到的回答")]))]
+    mock_generate_content_func.return_value = mock_response
+
+    deadline = gemini_handler.Deadline(time.time() - 700, budget=0, max_age=600)
+    final_text, _ = await gemini_handler.get_ai_response_async("test_chat", "你好", deadline=deadline)
+
+    assert final_text == "迟到的回答"
+    assert gemini_handler.conversation_sessions["test_chat"] == []
+    assert not os.path.exists(gemini_handler.SESSIONS_FILE)
+
+# --- 测试群聊批量回复 ---
+@pytest.mark.asyncio
+async def test_batched_response_maps_answers_and_updates_history(isolated_sessions):
+    router_response = MagicMock()
+    router_response.text = "GENERAL_CONVERSATION_INTENT"
+    batch_response = MagicMock()
+    batch_response.text = json.dumps([{'index': 2, 'answer': '小红你好'}, {'index': 1, 'answer': '小明你好'}], ensure_ascii=False)
+    mock_generate_content_func.side_effect = [router_response, batch_response]
+
+    answers, intent = await gemini_handler.get_batched_ai_response_async("群聊", [("小明", "你好"), ("小红", "在吗")])
+
+    assert answers == ['小明你好', '小红你好']
+    assert mock_generate_content_func.call_count == 2
+    history = [c.to_dict() for c in gemini_handler.conversation_sessions["群聊"]]
+    assert history[0] == {'role': 'user', 'parts': [{'text': '小明: 你好\n小红: 在吗'}]}
+    assert history[1] == {'role': 'model', 'parts': [{'text': '@小明 小明你好\n@小红 小红你好'}]}
+
+@pytest.mark.asyncio
+async def test_batched_response_defers_non_conversation_intents(isolated_sessions):
+    router_response = MagicMock()
+    router_response.text = "FUNCTION_CALL_INTENT"
+    mock_generate_content_func.return_value = router_response
+
+    answers, intent = await gemini_handler.get_batched_ai_response_async("群聊", [("小明", "抠图"), ("小红", "你好")])
+
+    assert answers == [None, None]
+    assert intent == "FUNCTION_CALL_INTENT"
+    assert mock_generate_content_func.call_count == 1
+    assert gemini_handler.conversation_sessions["群聊"] == []
+
+@pytest.mark.asyncio
+async def test_batched_response_answers_grounding_when_search_disabled(isolated_sessions, monkeypatch):
+    monkeypatch.setattr(gemini_handler, 'ENABLE_GOOGLE_SEARCH', False)
+    router_response = MagicMock()
+    router_response.text = "GROUNDING_INTENT"
+    batch_response = MagicMock()
+    batch_response.text = json.dumps([{'index': 1, 'answer': '晴'}, {'index': 2, 'answer': '你好'}], ensure_ascii=False)
+    mock_generate_content_func.side_effect = [router_response, batch_response]
+
+    answers, intent = await gemini_handler.get_batched_ai_response_async("群聊", [("小明", "今天天气"), ("小红", "你好")])
+
+    assert answers == ['晴', '你好']
+    assert intent == "GENERAL_CONVERSATION_INTENT"
+
+@pytest.mark.asyncio
+async def test_group_model_tier_ignores_sender_prefix(isolated_sessions, monkeypatch):
+    monkeypatch.setattr(gemini_handler, 'choose_model', MagicMock(wraps=gemini_handler.choose_model))
+    mock_response = MagicMock()
+    mock_response.text = "你好！"
+    mock_response.candidates = [types.Candidate(content=types.Content(role='model', parts=[types.Part(text="你好！")]))]
+    mock_generate_content_func.return_value = mock_response
+
+    await gemini_handler.get_ai_response_async(
+        "群聊", "一个很长很长的群昵称: 你好", is_group=True, sender_name="一个很长很长的群昵称",
+        intent="GENERAL_CONVERSATION_INTENT", message_for_policy="你好"
+    )
+
+    assert gemini_handler.choose_model.call_args.kwargs['message'] == "你好"
+
+@pytest.mark.asyncio
+async def test_known_intent_skips_router(isolated_sessions):
+    mock_response = MagicMock()
+    mock_response.text = "你好！"
+    mock_response.candidates = [types.Candidate(content=types.Content(role='model', parts=[types.Part(text="你好！")]))]
+    mock_generate_content_func.return_value = mock_response
+
+    final_text, _ = await gemini_handler.get_ai_response_async("群聊", "你好", is_group=True, sender_name="小明", intent="GENERAL_CONVERSATION_INTENT")
+
+    assert final_text == "你好！"
+    assert mock_generate_content_func.call_count == 1
+
+def test_parse_batch_answers_ignores_invalid_entries():
+    text = '```json\n[{"index": 1, "answer": "好的"}, {"index": 5, "answer": "越界"}, {"index": 2, "answer": "  "}, "垃圾"]\n```'
+    assert gemini_handler._parse_batch_answers(text, 3) == ['好的', None, None]
+    assert gemini_handler._parse_batch_answers("不是 JSON", 2) == [None, None]
+
+# --- 测试分割结果缓存 ---
+def _write_png(path, size, color, mode='RGB'):
+    from PIL import Image
+    Image.new(mode, size, color).save(path)
+
+@pytest.fixture
+def segmentation_env(monkeypatch, tmp_path):
+    import base64
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(gemini_handler, 'last_image_context', {})
+    monkeypatch.setattr(gemini_handler, '_segmentation_cache', {})
+    image_path = tmp_path / 'photo.png'
+    _write_png(image_path, (64, 64), (255, 0, 0))
+    mask_path = tmp_path / 'mask.png'
+    _write_png(mask_path, (16, 16), 255, mode='L')
+    mask_b64 = base64.b64encode(mask_path.read_bytes()).decode('ascii')
+    response = MagicMock()
+    response.text = json.dumps([{'box_2d': [0, 0, 500, 500], 'mask': mask_b64, 'label': 'cat'}])
+    mock_generate_content_func.return_value = response
+    return tmp_path, str(image_path)
+
+@pytest.mark.asyncio
+async def test_segmentation_cache_hit_skips_model_call(segmentation_env):
+    _, image_path = segmentation_env
+    gemini_handler.update_image_context('test_chat', image_path, time.time())
+
+    first = await gemini_handler.segment_image_async('test_chat', '把猫抠出来')
+    second = await gemini_handler.segment_image_async('test_chat', '请 把猫抠出来！')
+
+    assert first['status'] == 'success'
+    assert second['generated_files'] == first['generated_files']
+    assert mock_generate_content_func.call_count == 1
+
+@pytest.mark.asyncio
+async def test_segmentation_cache_rerenders_missing_files_without_model_call(segmentation_env):
+    _, image_path = segmentation_env
+    gemini_handler.update_image_context('test_chat', image_path, time.time())
+
+    first = await gemini_handler.segment_image_async('test_chat', '把猫抠出来')
+    for file_path in first['generated_files']:
+        os.remove(file_path)
+    second = await gemini_handler.segment_image_async('test_chat', '把猫抠出来')
+
+    assert second['status'] == 'success'
+    assert all(os.path.exists(f) for f in second['generated_files'])
+    assert mock_generate_content_func.call_count == 1
+
+@pytest.mark.asyncio
+async def test_segmentation_cache_kept_when_same_image_is_resent(segmentation_env):
+    tmp_path, image_path = segmentation_env
+    gemini_handler.update_image_context('test_chat', image_path, time.time())
+    first = await gemini_handler.segment_image_async('test_chat', '把猫抠出来')
+
+    resent_image = tmp_path / 'resent.png'
+    shutil.copyfile(image_path, resent_image)
+    gemini_handler.update_image_context('test_chat', str(resent_image), time.time())
+    second = await gemini_handler.segment_image_async('test_chat', '把猫抠出来')
+
+    assert len(gemini_handler._segmentation_cache) == 1
+    assert second['generated_files'] == first['generated_files']
+    assert all(os.path.exists(f) for f in second['generated_files'])
+    assert mock_generate_content_func.call_count == 1
+
+@pytest.mark.asyncio
+async def test_segmentation_cache_evicted_with_image_context(segmentation_env):
+    tmp_path, image_path = segmentation_env
+    gemini_handler.update_image_context('test_chat', image_path, time.time())
+    first = await gemini_handler.segment_image_async('test_chat', '把猫抠出来')
+
+    other_image = tmp_path / 'other.png'
+    _write_png(other_image, (64, 64), (0, 0, 255))
+    gemini_handler.update_image_context('test_chat', str(other_image), time.time())
+
+    assert gemini_handler._segmentation_cache == {}
+    assert not any(os.path.exists(f) for f in first['generated_files'])
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from group_batcher import GroupMentionBatcher, PendingMention
+
+
+def _mention(sender, question):
+    return PendingMention(msg=None, chat=None, sender=sender, question=question, deadline=None)
+
+@pytest.mark.asyncio
+async def test_mentions_within_window_are_batched():
+    batches = []
+    async def handler(chat_name, mentions):
+        batches.append((chat_name, [m.sender for m in mentions]))
+
+    batcher = GroupMentionBatcher(window_seconds=0.05, max_size=10, handler=handler)
+    batcher.add('群聊', _mention('小明', '问题1'))
+    batcher.add('群聊', _mention('小红', '问题2'))
+    batcher.add('另一个群', _mention('小刚', '问题3'))
+    assert batches == []
+
+    await asyncio.sleep(0.1)
+    assert sorted(batches) == sorted([('群聊', ['小明', '小红']), ('另一个群', ['小刚'])])
+
+@pytest.mark.asyncio
+async def test_full_batch_is_flushed_immediately():
+    batches = []
+    async def handler(chat_name, mentions):
+        batches.append([m.question for m in mentions])
+
+    batcher = GroupMentionBatcher(window_seconds=10, max_size=2, handler=handler)
+    batcher.add('群聊', _mention('小明', '问题1'))
+    batcher.add('群聊', _mention('小红', '问题2'))
+    batcher.add('群聊', _mention('小刚', '问题3'))
+    await asyncio.sleep(0)
+
+    assert batches == [['问题1', '问题2']]
+    assert batcher.pending_count('群聊') == 1
+
+@pytest.mark.asyncio
+async def test_handler_errors_do_not_break_batcher():
+    calls = []
+    async def handler(chat_name, mentions):
+        calls.append(len(mentions))
+        raise RuntimeError("boom")
+
+    batcher = GroupMentionBatcher(window_seconds=0.01, max_size=10, handler=handler)
+    batcher.add('群聊', _mention('小明', '问题1'))
+    await asyncio.sleep(0.05)
+    batcher.add('群聊', _mention('小红', '问题2'))
+    await asyncio.sleep(0.05)
+    assert calls == [1, 1]
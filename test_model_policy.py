@@ -0,0 +1,58 @@
+from unittest.mock import MagicMock
+
+from google.genai import types
+
+import model_policy
+from config import MODEL_TIERS
+
+
+def test_router_uses_router_tier():
+    choice = model_policy.choose_model('router')
+    assert choice.tier == model_policy.ROUTER_MODEL_TIER
+    assert choice.model == MODEL_TIERS[choice.tier][0]
+
+def test_short_greeting_uses_lite_tier():
+    choice = model_policy.choose_model('flow', intent='GENERAL_CONVERSATION_INTENT', message='你好')
+    assert choice.tier == 'lite'
+    assert choice.thinking_budget == 0
+
+def test_short_group_question_uses_lite_tier_regardless_of_sender(monkeypatch):
+    monkeypatch.setattr(model_policy, 'GROUP_GENERAL_MODEL_TIER', '')
+    bare = model_policy.choose_model('flow', intent='GENERAL_CONVERSATION_INTENT', message='你好', is_group=True)
+    prefixed = model_policy.choose_model('flow', intent='GENERAL_CONVERSATION_INTENT', message='一个很长很长的群昵称: 你好', is_group=True)
+    assert bare.tier == 'lite'
+    assert prefixed.tier == 'standard'
+
+def test_short_message_with_image_keeps_intent_tier():
+    choice = model_policy.choose_model('flow', intent='GENERAL_CONVERSATION_INTENT', message='这是啥', has_image=True)
+    assert choice.tier == 'standard'
+
+def test_function_call_intent_uses_configured_tier():
+    choice = model_policy.choose_model('flow', intent='FUNCTION_CALL_INTENT', message='抠图')
+    assert choice.tier == model_policy.MODEL_TIER_BY_INTENT['FUNCTION_CALL_INTENT']
+
+def test_unknown_tier_falls_back_to_standard(monkeypatch):
+    monkeypatch.setattr(model_policy, 'ROUTER_MODEL_TIER', 'nonexistent')
+    assert model_policy.choose_model('router').tier == 'standard'
+
+def test_apply_thinking_budget_keeps_explicit_config():
+    choice = model_policy.ModelChoice('lite', 'some-model', 0)
+    config = model_policy.apply_thinking_budget(types.GenerateContentConfig(), choice)
+    assert config.thinking_config.thinking_budget == 0
+
+    explicit = types.GenerateContentConfig(thinking_config=types.ThinkingConfig(thinking_budget=512))
+    assert model_policy.apply_thinking_budget(explicit, choice).thinking_config.thinking_budget == 512
+
+def test_record_call_accumulates_tokens_per_tier(monkeypatch):
+    monkeypatch.setattr(model_policy, 'tier_stats', {})
+    response = MagicMock()
+    response.usage_metadata = types.GenerateContentResponseUsageMetadata(prompt_token_count=10, candidates_token_count=5)
+    choice = model_policy.ModelChoice('lite', 'some-model', 0)
+    model_policy.record_call(choice, 0.0, response)
+    model_policy.record_call(choice, 0.0, MagicMock(), error=True)
+
+    stats = model_policy.tier_stats['lite']
+    assert stats['calls'] == 2
+    assert stats['errors'] == 1
+    assert stats['prompt_tokens'] == 10
+    assert stats['output_tokens'] == 5
@@ -0,0 +1,63 @@
+import asyncio
+import json
+import os
+import pytest
+
+import profiler
+
+
+@pytest.fixture(autouse=True)
+def profiler_env(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler, 'PROFILE_DIR', str(tmp_path / 'profiles'))
+    monkeypatch.setattr(profiler, 'PROFILE_SWITCH_FILE', str(tmp_path / 'profile_switch.txt'))
+    monkeypatch.setattr(profiler, '_switch_file_mtime', None)
+    monkeypatch.setattr(profiler.settings, 'enabled', True)
+    monkeypatch.setattr(profiler.settings, 'every_n', 1)
+    monkeypatch.setattr(profiler.settings, 'sample_interval_ms', 1)
+    monkeypatch.setattr(profiler.settings, 'slow_threshold_ms', 0)
+    yield tmp_path
+
+@pytest.mark.asyncio
+async def test_slow_message_writes_timeline_and_samples(profiler_env):
+    async with profiler.message_scope('message'):
+        profiler.annotate(chat_name='test_chat')
+        async with profiler.message_scope('get_ai_response_async'):
+            with profiler.stage('intent_router'):
+                await asyncio.sleep(0.05)
+
+    dump_dir = profiler_env / 'profiles'
+    timeline_files = [f for f in os.listdir(dump_dir) if f.endswith('.json')]
+    assert len(timeline_files) == 1
+    with open(dump_dir / timeline_files[0], encoding='utf-8') as f:
+        timeline = json.load(f)
+    assert timeline['meta']['chat_name'] == 'test_chat'
+    assert [s['stage'] for s in timeline['stages']] == ['intent_router', 'get_ai_response_async']
+    assert any(f.endswith('.folded') for f in os.listdir(dump_dir))
+
+@pytest.mark.asyncio
+async def test_fast_message_is_not_dumped(profiler_env, monkeypatch):
+    monkeypatch.setattr(profiler.settings, 'slow_threshold_ms', 60000)
+    async with profiler.message_scope('message') as trace:
+        with profiler.stage('send_text'):
+            pass
+    assert trace is not None and trace.stages[0]['stage'] == 'send_text'
+    assert not os.path.exists(profiler_env / 'profiles')
+
+@pytest.mark.asyncio
+async def test_switch_file_disables_profiling_at_runtime(profiler_env):
+    (profiler_env / 'profile_switch.txt').write_text("enabled=false\nevery_n=3\n", encoding='utf-8')
+    async with profiler.message_scope('message') as trace:
+        pass
+    assert trace is None
+    assert profiler.settings.every_n == 3
+
+@pytest.mark.asyncio
+async def test_sampler_thread_stops_when_no_message_is_sampled(profiler_env):
+    async with profiler.message_scope('message'):
+        await asyncio.sleep(0.02)
+        sampler = profiler._sampler_thread
+        assert sampler is not None and sampler.is_alive()
+
+    sampler.join(timeout=1)
+    assert not sampler.is_alive()
+    assert profiler._sampler_thread is None
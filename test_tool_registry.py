@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+import pytest
+from google.genai import types
+
+import tool_registry
+from tool_registry import register_tool, execute_tool_calls, get_tools
+
+
+def _declaration(name):
+    return types.FunctionDeclaration(name=name, description=f"测试工具 {name}")
+
+@pytest.fixture(autouse=True)
+def isolated_registry(monkeypatch):
+    monkeypatch.setattr(tool_registry, 'TOOL_REGISTRY', {})
+    monkeypatch.setattr(tool_registry, 'tool_stats', {})
+
+def _sleeping_runner(seconds, events=None):
+    async def runner(contact_name, user_message, args):
+        if events is not None:
+            events.append(('start', args.get('id')))
+        await asyncio.sleep(seconds)
+        if events is not None:
+            events.append(('end', args.get('id')))
+        return {'status': 'success', 'id': args.get('id')}
+    return runner
+
+@pytest.mark.asyncio
+async def test_concurrent_safe_tools_run_at_the_same_time():
+    register_tool(_declaration('slow_a'), _sleeping_runner(0.1))
+    register_tool(_declaration('slow_b'), _sleeping_runner(0.1))
+    calls = [types.FunctionCall(name='slow_a', args={'id': 1}), types.FunctionCall(name='slow_b', args={'id': 2})]
+
+    started = time.perf_counter()
+    results = await execute_tool_calls(calls, 'chat', '消息')
+    elapsed = time.perf_counter() - started
+
+    assert elapsed < 0.18
+    assert results == [('slow_a', {'status': 'success', 'id': 1}), ('slow_b', {'status': 'success', 'id': 2})]
+
+@pytest.mark.asyncio
+async def test_unsafe_tools_run_one_after_another():
+    events = []
+    register_tool(_declaration('writer'), _sleeping_runner(0.01, events), concurrent_safe=False)
+    calls = [types.FunctionCall(name='writer', args={'id': 1}), types.FunctionCall(name='writer', args={'id': 2})]
+
+    await execute_tool_calls(calls, 'chat', '消息')
+
+    assert events == [('start', 1), ('end', 1), ('start', 2), ('end', 2)]
+
+@pytest.mark.asyncio
+async def test_timeouts_errors_and_unknown_tools_are_reported_to_the_model():
+    async def broken(contact_name, user_message, args):
+        raise RuntimeError("boom")
+
+    register_tool(_declaration('slow'), _sleeping_runner(1), timeout=0.05)
+    register_tool(_declaration('broken'), broken)
+    calls = [types.FunctionCall(name='slow', args={}), types.FunctionCall(name='broken', args={}), types.FunctionCall(name='missing', args={})]
+
+    results = await execute_tool_calls(calls, 'chat', '消息')
+
+    assert [name for name, _ in results] == ['slow', 'broken', 'missing']
+    assert all(result['status'] == 'error' for _, result in results)
+    assert tool_registry.tool_stats['slow']['timeouts'] == 1
+    assert tool_registry.tool_stats['broken']['failures'] == 1
+    assert 'missing' not in tool_registry.tool_stats
+
+@pytest.mark.asyncio
+async def test_stats_record_latency_per_tool():
+    register_tool(_declaration('quick'), _sleeping_runner(0.02))
+
+    await execute_tool_calls([types.FunctionCall(name='quick', args={'id': 1})], 'chat', '消息')
+
+    stats = tool_registry.tool_stats['quick']
+    assert stats['calls'] == 1 and stats['failures'] == 0
+    assert stats['max_latency_ms'] >= 15
+
+def test_get_tools_lists_registered_declarations():
+    assert get_tools() == []
+    register_tool(_declaration('a'), _sleeping_runner(0))
+    register_tool(_declaration('b'), _sleeping_runner(0))
+    assert [d.name for d in get_tools()[0].function_declarations] == ['a', 'b']
+
+@pytest.mark.asyncio
+async def test_stats_are_logged_every_n_tool_calls(monkeypatch):
+    log_calls = []
+    monkeypatch.setattr(tool_registry, 'TOOL_STATS_LOG_EVERY', 2)
+    monkeypatch.setattr(tool_registry, '_total_tool_calls', 0)
+    monkeypatch.setattr(tool_registry, 'log_tool_stats', lambda: log_calls.append(True))
+    register_tool(_declaration('quick'), _sleeping_runner(0))
+
+    for i in range(5):
+        await execute_tool_calls([types.FunctionCall(name='quick', args={'id': i})], 'chat', '消息')
+
+    assert len(log_calls) == 2
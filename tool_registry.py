@@ -0,0 +1,119 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+from google.genai import types
+from config import TOOL_STATS_LOG_EVERY
+from logger import logger
+
+# =================================================================
+#  工具注册表
+#
+#  每个工具声明自己的 FunctionDeclaration、是否可以与其他工具并发执行、
+#  以及超时时间。模型在一轮中请求的多个工具调用会并发执行，
+#  每个工具的延迟与失败次数会被记录下来。
+# =================================================================
+
+# 工具执行函数: runner(contact_name, user_message, args) -> 结果字典
+ToolRunner = Callable[[str, str, Dict[str, Any]], Awaitable[Dict[str, Any]]]
+
+
+class ToolSpec(NamedTuple):
+    declaration: types.FunctionDeclaration
+    runner: ToolRunner
+    concurrent_safe: bool = True  # 为 False 时与其他非并发安全的工具依次执行
+    timeout: Optional[float] = None  # 秒，None 表示不限
+
+
+TOOL_REGISTRY: Dict[str, ToolSpec] = {}
+tool_stats: Dict[str, Dict[str, Any]] = {}
+_total_tool_calls = 0
+
+
+def register_tool(declaration: types.FunctionDeclaration, runner: ToolRunner, concurrent_safe: bool = True, timeout: Optional[float] = None):
+    """注册一个可供模型调用的工具，名称取自 declaration.name。"""
+    TOOL_REGISTRY[declaration.name] = ToolSpec(declaration, runner, concurrent_safe, timeout)
+
+
+def get_tools() -> List[types.Tool]:
+    """返回所有已注册工具的声明，用于模型请求配置。"""
+    if not TOOL_REGISTRY:
+        return []
+    return [types.Tool(function_declarations=[spec.declaration for spec in TOOL_REGISTRY.values()])]
+
+
+def _record_tool_call(name: str, latency_ms: float, failed: bool, timed_out: bool):
+    global _total_tool_calls
+    stats = tool_stats.setdefault(name, {'calls': 0, 'failures': 0, 'timeouts': 0, 'total_latency_ms': 0.0, 'max_latency_ms': 0.0})
+    stats['calls'] += 1
+    stats['total_latency_ms'] += latency_ms
+    stats['max_latency_ms'] = max(stats['max_latency_ms'], latency_ms)
+    if failed:
+        stats['failures'] += 1
+    if timed_out:
+        stats['timeouts'] += 1
+    _total_tool_calls += 1
+    if TOOL_STATS_LOG_EVERY > 0 and _total_tool_calls % TOOL_STATS_LOG_EVERY == 0:
+        log_tool_stats()
+
+
+async def _execute_tool_call(func_call: types.FunctionCall, contact_name: str, user_message: str) -> Dict[str, Any]:
+    name = func_call.name or ''
+    spec = TOOL_REGISTRY.get(name)
+    if spec is None:
+        logger.warning(f"模型请求了未注册的工具 '{name}'。")
+        return {'status': 'error', 'message': f"未知的工具 '{name}'。"}
+
+    args = dict(func_call.args or {})
+    logger.debug(f"执行工具 '{name}'，参数: {args}")
+    started = time.perf_counter()
+    timed_out = False
+    try:
+        if spec.timeout:
+            result = await asyncio.wait_for(spec.runner(contact_name, user_message, args), timeout=spec.timeout)
+        else:
+            result = await spec.runner(contact_name, user_message, args)
+    except asyncio.TimeoutError:
+        timed_out = True
+        logger.warning(f"工具 '{name}' 执行超时 ({spec.timeout} 秒)。")
+        result = {'status': 'error', 'message': "抱歉，工具执行超时了，请稍后再试。"}
+    except Exception as e:
+        logger.error(f"工具 '{name}' 执行失败: {e}", exc_info=True)
+        result = {'status': 'error', 'message': "抱歉，工具执行时遇到了一个内部错误。"}
+
+    latency_ms = (time.perf_counter() - started) * 1000
+    failed = not (isinstance(result, dict) and result.get('status') == 'success')
+    _record_tool_call(name, latency_ms, failed, timed_out)
+    logger.info(f"工具 '{name}' 执行{'失败' if failed else '成功'}，耗时 {latency_ms:.0f}ms。")
+    return result
+
+
+async def execute_tool_calls(function_calls: List[types.FunctionCall], contact_name: str, user_message: str) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    执行模型在一轮中请求的所有工具调用，按请求顺序返回 (工具名, 结果)。
+    并发安全的工具同时执行；其余工具在一个单独的任务中依次执行，二者互不等待。
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(function_calls)
+
+    async def run_one(index: int):
+        results[index] = await _execute_tool_call(function_calls[index], contact_name, user_message)
+
+    async def run_serial(indexes: List[int]):
+        for index in indexes:
+            await run_one(index)
+
+    concurrent_indexes, serial_indexes = [], []
+    for i, func_call in enumerate(function_calls):
+        spec = TOOL_REGISTRY.get(func_call.name or '')
+        (serial_indexes if spec is not None and not spec.concurrent_safe else concurrent_indexes).append(i)
+
+    await asyncio.gather(*(run_one(i) for i in concurrent_indexes), run_serial(serial_indexes))
+    return [(function_calls[i].name or '', results[i]) for i in range(len(function_calls))]
+
+
+def log_tool_stats():
+    for name, stats in tool_stats.items():
+        avg_latency = stats['total_latency_ms'] / stats['calls'] if stats['calls'] else 0
+        logger.info(
+            f"[工具统计] {name}: 调用 {stats['calls']} 次 (失败 {stats['failures']}，超时 {stats['timeouts']})，"
+            f"平均延迟 {avg_latency:.0f}ms，最大延迟 {stats['max_latency_ms']:.0f}ms"
+        )